@@ -28,9 +28,11 @@ def main(indir, channel_ls=[], loop_ls=[], well_range='', mode='', cluster=None,
     elif mode == 'bpm':
         script_python = 'medaka_bpm.py'
         memory_job = str(config['DEFAULT']['MEM_BPM'])
+    elif mode == 'crop_bpm':
+        # Cropping and BPM analysis in the same job. The cropped video is handed over in memory.
+        script_python = 'medaka_crop.py'
+        memory_job = str(max(int(config['DEFAULT']['MEM_CROP']), int(config['DEFAULT']['MEM_BPM'])))
         
-    #TODO: If both?
-    
     experiment_name = os.path.basename(os.path.normpath(indir))
     experiment_id = '_'.join(experiment_name.split('/')[0:2])
     setup.config_logger(os.path.join(outdir, 'log'), ("logfile_dispatch_" + experiment_id + ".log"), debug)
@@ -38,7 +40,9 @@ def main(indir, channel_ls=[], loop_ls=[], well_range='', mode='', cluster=None,
     LOGGER.debug('Input directory ' + str(indir))
     LOGGER.debug('Output directory ' + str(outdir))
 
-    nr_of_videos, channels, loops, wells = io_operations.extract_data(indir)
+    # Persist the frame index in the experiment outdir. The dispatched jobs reuse it instead of listing the folder again.
+    frame_index = io_operations.load_frame_index(indir, setup.experiment_outdir(indir, outdir))
+    nr_of_videos, channels, loops, wells = io_operations.extract_data(indir, frame_index=frame_index)
     
     # Extract Video metadata
     LOGGER.info("Deduced number of videos: " + str(nr_of_videos))
@@ -46,6 +50,8 @@ def main(indir, channel_ls=[], loop_ls=[], well_range='', mode='', cluster=None,
     LOGGER.info("Deduced number of Loops: " + str(len(loops)))
 
     max_subprocesses = int(config['DEFAULT']['MAX_PARALLEL_DIRS'])
+    # Cores divided among the parallel processes, 0 for all available cores
+    max_cores = config['DEFAULT'].getint('MAX_CORES')
 
     #QUESTION: Why is it not in the process argument part ?
     if channel_ls:
@@ -107,12 +113,13 @@ def main(indir, channel_ls=[], loop_ls=[], well_range='', mode='', cluster=None,
         LOGGER.info("Running on a single machine the {} processes".format(len(python_cmd_ls)))
         LOGGER.debug(python_cmd_ls[:5])
         # print("Running multifolder mode. Limited console feedback, check logfiles for process status")
-        run_processes(python_cmd_ls, max_subprocesses, log=sys.stdout)
+        run_processes(python_cmd_ls, max_subprocesses, log=sys.stdout, cores=max_cores)
 
 
     ## CONSOLIDATION ##
     #Gather output in the same once every job is finished
-    consolidate_python_cmd = prepare_python_cmd(dict(indir=outdir, outdir=outdir, debug=debug), os.path.join('src', 'cluster_consolidate.py'))
+    # The jobs write their results journal into the experiment outdir
+    consolidate_python_cmd = prepare_python_cmd(dict(indir=setup.experiment_outdir(indir, outdir), outdir=outdir, debug=debug), os.path.join('src', 'cluster_consolidate.py'))
     if (cluster == True) and (mode != 'crop'):
         # consolidate_python_cmd = prepare_python_cmd(dict(indir= os.path.join(outdir, 'results'), outdir=outdir), os.path.join('src', 'cluster_consolidate.py'))
         consolidate_cluster_kwargs = dict(script=consolidate_python_cmd,
@@ -133,7 +140,7 @@ def main(indir, channel_ls=[], loop_ls=[], well_range='', mode='', cluster=None,
         LOGGER.info("Running on a single machine the {} processes".format(len(python_cmd_ls)))
         LOGGER.debug(python_cmd_ls[:5])
         # print("Running multifolder mode. Limited console feedback, check logfiles for process status")
-        run_processes(python_cmd_ls, max_subprocesses, log=sys.stdout)
+        run_processes(python_cmd_ls, max_subprocesses, log=sys.stdout, cores=max_cores)
         if mode != 'crop':
             LOGGER.debug('#Consolidate command' + '\t'.join(consolidate_python_cmd))
             conso_out = subprocess.run(consolidate_python_cmd,  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
@@ -151,6 +158,8 @@ if __name__ == '__main__':
     
     if args.crop:
         mode = 'crop'
+    elif args.crop_bpm:
+        mode = 'crop_bpm'
     else:
         mode ='bpm'
 
@@ -22,7 +22,7 @@ import pandas as pd
 import src.io_operations as io_operations
 import src.setup as setup
 import src.segment_heart as segment_heart
-from src.job_utils import return_jobindex
+from src.job_utils import return_jobindex, limit_threads, process_thread_budget
 
 # QC Analysis modules.
 from qc_analysis.decision_tree.src import analysis as qc_analysis
@@ -37,116 +37,211 @@ config = configparser.ConfigParser()
 config.read(config_path)
 
 ################################## GLOBAL VARIABLES ###########################
-# LOGGER = logging.getLogger(__name__)
+LOGGER = logging.getLogger(__name__)
 
 ################################## ALGORITHM ##################################
 # Analyse a range of wells
-def analyse_directory(indir, args, channels, loops, wells=None):
+def analyse_directory(indir, args, channels, loops, wells=None, frame_index=None):
     LOGGER.info("The analysis for each well can take one to several minutes")
     LOGGER.info("Running....please wait...")
 
-    # Results for all wells
-    results = pd.DataFrame()
+    # Results for all wells, one list per column. See io_operations.append_result()
+    results = {}
 
     # Get trained model, if present. 
     trained_tree = io_operations.load_decision_tree()
     
-    try:
-        for well_frame_paths, video_metadata in io_operations.well_video_generator(indir, channels, loops):
-            
-            well_nr = int(video_metadata['well_id'][-3:])
-            if wells is not None and well_nr not in wells:
+    # Embryo regions stored by a virtual crop (medaka_crop.py). Only these are loaded from the frames.
+    virtual_crop = config['CROPPING'].getboolean('VIRTUAL_CROP')
+
+    # Only load videos of the selected wells
+    def well_videos():
+        for well_frame_paths, video_metadata in io_operations.well_video_generator(indir, channels, loops, frame_index):
+            if wells is not None and int(video_metadata['well_id'][-3:]) not in wells:
                 continue
 
+            if virtual_crop:
+                video_metadata['crop_region'] = io_operations.load_crop_coordinates(args.outdir, video_metadata)
+                if video_metadata['crop_region'] is None:
+                    LOGGER.warning("No crop coordinates found for well " + video_metadata['well_id'] + ". Loading full frames.")
+
+            yield well_frame_paths, video_metadata
+
+    # Next videos are decoded in the background while the current one is analysed
+    prefetch_depth = config['IO'].getint('PREFETCH_WELLS')
+
+    # Quality control plots are rendered in background processes while the next wells are analysed.
+    # Within a thread budget, one thread stays with the analysis and every worker renders with a single thread.
+    artifact_workers = config['IO'].getint('ARTIFACT_WORKERS')
+    thread_budget = process_thread_budget()
+    if thread_budget is not None and artifact_workers > thread_budget - 1:
+        artifact_workers = thread_budget - 1
+        LOGGER.debug(f"{artifact_workers} artifact workers within the thread budget of {thread_budget} threads")
+    segment_heart.start_artifact_renderer(artifact_workers)
+
+    try:
+        for well_frame_paths, video_metadata, video in io_operations.prefetch_videos(well_videos(), imread_flag=0, depth=prefetch_depth):
+
             # Results of current well
-            well_result = {}
-            bpm = None
-            fps = None
-            qc_attributes = {}
-            
-            try:
-                bpm, fps, qc_attributes = analyse_well(well_frame_paths, video_metadata, args)
-                LOGGER.info(f"Reported BPM: {str(bpm)}")
-                
-                # Process data.
-                # Important to rearrange the qc params in the same order used during training.
-                # Easiest way to do that is to convert the qc_attributes to a dataframe and reorder the columns.
-                # 'Stop frame' is not used during training.
-                if trained_tree and bpm:
-                    data = {k: v for k, v in qc_attributes.items() if k not in ["Stop frame"]}
-                    data = pd.DataFrame.from_dict(qc_attributes, orient = "index").transpose()[qc_analysis.QC_FEATURES]
-                    
-                    # Get the qc parameter results evaluated by the decision tree as a dictionary.
-                    qc_analysis_results = qc_analysis.evaluate(trained_tree, data)
-                    well_result["qc_param_decision"] = qc_analysis_results[0]
-
-                # qc_attributes may help in dev to improve the algorithm, but are unwanted in production.
-                if True: #args.debug:
-                    well_result.update(qc_attributes)
-
-            except Exception as e:
-                LOGGER.exception("Couldn't acquier BPM for well " + str(video_metadata['well_id'])
-                                    + " in loop " +
-                                    str(video_metadata['loop'])
-                                    + " with channel " + str(video_metadata['channel']))
-                well_result['error'] = "Error during processing. Check log files"
-
-            finally:
-                well_result['well_id']  = video_metadata['well_id']
-                well_result['loop']     = video_metadata['loop']
-                well_result['channel']  = video_metadata['channel']
-                well_result['bpm']      = bpm
-                well_result['fps']      = fps
-                well_result['version']  = config['DEFAULT']['VERSION']
-                
-                well_result = pd.DataFrame(well_result, index=[0])
-                results = pd.concat([results, well_result], ignore_index=True)
-
-                gc.collect()
+            well_result = evaluate_well(well_frame_paths, video_metadata, args, trained_tree, video)
+
+            io_operations.append_result(results, well_result)
+
+            gc.collect()
 
     except Exception as e:
         LOGGER.exception("Couldn't finish analysis")
         sys.exit()
 
-    return results
+    finally:
+        # All plots are written before the results are reported
+        segment_heart.stop_artifact_renderer()
+
+    return io_operations.results_frame(results)
+
+# Analyse a single well and evaluate its qc attributes with the trained decision tree.
+# Returns the result entry of the well. Errors are logged and noted in the result.
+def evaluate_well(well_frame_paths, video_metadata, args, trained_tree, video=None):
+    well_result = {}
+    bpm = None
+    fps = None
+    qc_attributes = {}
+    
+    try:
+        bpm, fps, qc_attributes = analyse_well(well_frame_paths, video_metadata, args, video)
+        LOGGER.info(f"Reported BPM: {str(bpm)}")
+        
+        # Process data.
+        # Important to rearrange the qc params in the same order used during training.
+        # Easiest way to do that is to convert the qc_attributes to a dataframe and reorder the columns.
+        # 'Stop frame' is not used during training.
+        if trained_tree and bpm:
+            data = {k: v for k, v in qc_attributes.items() if k not in ["Stop frame"]}
+            data = pd.DataFrame.from_dict(qc_attributes, orient = "index").transpose()[qc_analysis.QC_FEATURES]
+            
+            # Get the qc parameter results evaluated by the decision tree as a dictionary.
+            qc_analysis_results = qc_analysis.evaluate(trained_tree, data)
+            well_result["qc_param_decision"] = qc_analysis_results[0]
+
+        # qc_attributes may help in dev to improve the algorithm, but are unwanted in production.
+        if True: #args.debug:
+            well_result.update(qc_attributes)
+
+    except Exception as e:
+        LOGGER.exception("Couldn't acquier BPM for well " + str(video_metadata['well_id'])
+                            + " in loop " +
+                            str(video_metadata['loop'])
+                            + " with channel " + str(video_metadata['channel']))
+        well_result['error'] = "Error during processing. Check log files"
+
+    finally:
+        well_result['well_id']  = video_metadata['well_id']
+        well_result['loop']     = video_metadata['loop']
+        well_result['channel']  = video_metadata['channel']
+        well_result['bpm']      = bpm
+        well_result['fps']      = fps
+        well_result['version']  = config['DEFAULT']['VERSION']
+
+    journal_result(well_result, args)
+
+    return well_result
+
+# Result entry of a well that failed before its analysis, e.g. while cropping it (medaka_crop.py --crop_bpm)
+def failed_well_result(video_metadata, args, error):
+    well_result = { 'error'     : error,
+                    'well_id'   : video_metadata['well_id'],
+                    'loop'      : video_metadata['loop'],
+                    'channel'   : video_metadata['channel'],
+                    'bpm'       : None,
+                    'fps'       : None,
+                    'version'   : config['DEFAULT']['VERSION']}
+
+    journal_result(well_result, args)
+
+    return well_result
+
+# Keep the result on disk right away, in case the job is killed before the results are written
+def journal_result(well_result, args):
+    try:
+        io_operations.append_to_journal(Path(args.outdir) / "results", well_result, io_operations.settings_hash(args))
+    except Exception:
+        LOGGER.exception("Couldn't write result of well " + str(well_result['well_id']) + " to the results journal")
 
 # Run algorithm on a single well
-def analyse_well(well_frame_paths, video_metadata, args):
+# video: Already loaded video of the well, e.g. by the prefetching in analyse_directory. Loaded from well_frame_paths if None.
+def analyse_well(well_frame_paths, video_metadata, args, video=None):
     LOGGER.info("Analysing video - "
                 + "Channel: " + str(video_metadata['channel'])
                 + " Loop: " + str(video_metadata['loop'])
                 + " Well: " + str(video_metadata['well_id'])
                 )
 
-    # TODO: I/O is very slow, 1 video ~500mb ~20s locally. Buffer video loading for single machine?
     # Load video
     video_metadata['timestamps'] = io_operations.extract_timestamps(well_frame_paths)
 
-    video = io_operations.load_video(well_frame_paths, imread_flag=0)
+    # Loading failed in the prefetching thread
+    if isinstance(video, Exception):
+        raise video
+
+    if video is None:
+        video = io_operations.load_cached_video(well_frame_paths, imread_flag=0, region=video_metadata.get('crop_region'))
 
     bpm, fps, qc_attributes = segment_heart.run(video, vars(args), video_metadata)
 
     return bpm, fps, qc_attributes
 
 
-def main(indir, outdir, well_id, loop, channel, args, debug=False):
+# well_id: A single well or a list of wells. Several wells are analysed in one go, which allows prefetching their videos.
+def main(indir, outdir, well_id, loop, channel, args, debug=False, frame_index=None):
     ################################## STARTUP SETUP ##################################
+    well_ids = [well_id] if isinstance(well_id, str) else list(well_id)
+
     LOGGER.info("#######################")
-    LOGGER.info("Program started with the following arguments: " + '\t'.join([str(indir), str(outdir), well_id, loop, channel]))
-    analysis_id = '_'.join([well_id, loop, channel]) 
+    LOGGER.info("Program started with the following arguments: " + '\t'.join([str(indir), str(outdir), ','.join(well_ids), loop, channel]))
+
+    # Threads per process when started by dispatch_jobs.py
+    limit_threads()
+
+    if len(well_ids) == 1:
+        analysis_id = '_'.join([well_ids[0], loop, channel])
+    else:
+        analysis_id = '_'.join([loop, channel])
     
     ################################## MAIN PROGRAM START ##################################
-    pattern = '*{}*{}*{}*.tif'.format(well_id, loop, channel)
-    nr_files_for_analysis = list(indir.glob(pattern)) + list(indir.glob(pattern + 'f'))
-    if len(nr_files_for_analysis) <= 0:
-        LOGGER.error("Did not found any files corresponding")
-        LOGGER.debug('Files correponding to following pattern {}: {}'.format(pattern, len(nr_files_for_analysis)))
+    if frame_index is None:
+        frame_index = io_operations.index_directory(indir)
+
+    # With --resume, wells already in the results journal with the same version and settings are not analysed again, unless they failed
+    journal = {}
+    if getattr(args, 'resume', False):
+        journal = io_operations.read_journal(Path(outdir / "results"), io_operations.settings_hash(args))
+
+    wells = []
+    resumed_results = []
+    for well in well_ids:
+        if (well, loop, channel) in journal:
+            LOGGER.info(f'Well {well} already analysed, taking result from the results journal')
+            resumed_results.append(journal[(well, loop, channel)])
+            continue
+
+        nr_files_for_analysis = len(io_operations.query_frame_index(frame_index, channel=channel, loop=loop, well_id=well))
+        LOGGER.debug('Files correponding to {}: {}'.format('_'.join([well, loop, channel]), nr_files_for_analysis))
+        if nr_files_for_analysis <= 0:
+            LOGGER.error("Did not found any files corresponding to well " + well)
+        else:
+            LOGGER.info(f'Found {nr_files_for_analysis} for the analysis of well {well}')
+            wells.append(int(well[-3:]))
+
+    if not wells and not resumed_results:
         raise Exception('No File Found') 
     else:
-        LOGGER.info(f'Found {len(nr_files_for_analysis)} for the analysis')
-        LOGGER.debug('Files correponding to following pattern {}: {}'.format(pattern, len(nr_files_for_analysis)))
-        well_nr = int(well_id[-3:])
-        results = analyse_directory(indir, args, [channel], [loop], wells=[well_nr])
+        results = pd.DataFrame()
+        if wells:
+            results = analyse_directory(indir, args, [channel], [loop], wells=wells, frame_index=frame_index)
+
+        if resumed_results:
+            results = pd.concat([pd.DataFrame(resumed_results), results], ignore_index=True)
+            results = results.sort_values(by='well_id', kind='stable', ignore_index=True)
 
         ################################## OUTPUT ##################################
         io_operations.write_to_spreadsheet(Path(outdir / "results"), results, analysis_id)
@@ -215,6 +310,11 @@ if __name__ == '__main__':
                         help='maxjobs on the cluster',
                         required=False)
     
+    parser.add_argument('--resume',
+                        action="store_true",
+                        help='Skip wells already in the results journal of outdir',
+                        required=False)
+
     parser.add_argument('--debug',
                         action="store_true",
                         help='Additional debug output',
@@ -230,10 +330,13 @@ if __name__ == '__main__':
     args.loops =  list(args.loops)[0]
     args.channels =list(args.channels)[0]
     
+    # Scan the input directory only once for all wells
+    frame_index = io_operations.load_frame_index(args.indir, args.outdir)
+
     if args.well_id:
         analysis_id = '_'.join([args.well_id, args.loops,  args.channels]) 
         setup.config_logger(os.path.join(args.outdir, 'log'), ("logfile_hrt_bpm_" + analysis_id + ".log"), args.debug)
-        main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=args.well_id, loop=args.loops, channel=args.channels, debug=args.debug, args=args)
+        main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=args.well_id, loop=args.loops, channel=args.channels, debug=args.debug, args=args, frame_index=frame_index)
         sys.exit(0)
     elif args.well_array:
         range_wells = args.well_array[1:-1].split('-')
@@ -251,20 +354,19 @@ if __name__ == '__main__':
         well_id = well_ls[job_index -1]
         analysis_id = '_'.join([well_id, args.loops, args.channels]) 
         setup.config_logger(os.path.join(args.outdir, 'log'), ("logfile_hrt_bpm_" + analysis_id + ".log"), args.debug)
-        main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=well_id, loop=args.loops, channel=args.channels, debug=args.debug, args=args)
+        main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=well_id, loop=args.loops, channel=args.channels, debug=args.debug, args=args, frame_index=frame_index)
     
     elif len(well_ls) == 1:
         analysis_id = '_'.join([well_ls[0], args.loops, args.channels]) 
         setup.config_logger(os.path.join(args.outdir, 'log'), ("logfile_hrt_bpm_" + analysis_id + ".log"), args.debug)
-        main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=well_ls[0], loop=args.loops, channel=args.channels, debug=args.debug, args=args)
+        main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=well_ls[0], loop=args.loops, channel=args.channels, debug=args.debug, args=args, frame_index=frame_index)
     
     else:
-        #FIXME: Find a better way to run several wells at a time, multiprocesses ?
-        for well_id in well_ls: 
-            analysis_id = '_'.join([args.loops, args.channels]) 
-            setup.config_logger(os.path.join(args.outdir, 'log'), ("logfile_hrt_bpm_" + analysis_id + ".log"), args.debug)
-            try:
-                main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=well_id, loop=args.loops, channel=args.channels, debug=args.debug, args=args)
-            except Exception:
-                LOGGER.error('Error with well_id {}.'.format(well_id), exc_info=True)
-                pass                
\ No newline at end of file
+        # All wells are analysed in one go, so the video of the next well is loaded while the current one is analysed.
+        analysis_id = '_'.join([args.loops, args.channels]) 
+        setup.config_logger(os.path.join(args.outdir, 'log'), ("logfile_hrt_bpm_" + analysis_id + ".log"), args.debug)
+        try:
+            main(indir=Path(args.indir), outdir=Path(args.outdir), well_id=well_ls, loop=args.loops, channel=args.channels, debug=args.debug, args=args, frame_index=frame_index)
+        except Exception:
+            LOGGER.error('Error with well_ids {}.'.format(', '.join(well_ls)), exc_info=True)
+            pass                
\ No newline at end of file
@@ -17,13 +17,18 @@ from pathlib import Path
 import argparse
 import os
 import sys 
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
+import numpy as np
+
 import src.io_operations as io_operations
 import src.setup as setup
 import src.cropping as cropping
-from src.job_utils import return_jobindex
+from src.job_utils import return_jobindex, limit_threads
+
+import medaka_bpm
 
 # QC Analysis modules.
 from qc_analysis.decision_tree.src import analysis as qc_analysis
@@ -42,18 +47,58 @@ config.read(config_path)
 # LOGGER = logging.getLogger(__name__)
 ################################## ALGORITHM ##################################
 
-def main(indir, outdir, well_id, loop, channel, args, debug=False):
+# With args.crop_bpm, the heart rate is analysed right away on the cropped video in memory (fused crop and BPM job).
+def main(indir, outdir, well_id, loop, channel, args, debug=False, frame_index=None):
     LOGGER.info("#######################")
-    LOGGER.info("Only cropping, script will not run BPM analyses")
+
+    # Threads per process when started by dispatch_jobs.py
+    limit_threads()
+
+    crop_bpm = getattr(args, 'crop_bpm', False)
+    if crop_bpm:
+        LOGGER.info("Cropping and analysing BPM on the cropped videos")
+        trained_tree = io_operations.load_decision_tree()
+        save_cropped = config['CROPPING'].getboolean('SAVE_CROPPED')
+        results = {}
+
+        # With --resume, wells already in the results journal are neither cropped nor analysed again, unless they failed
+        journal = {}
+        if getattr(args, 'resume', False):
+            journal = io_operations.read_journal(Path(outdir / "results"), io_operations.settings_hash(args))
+    else:
+        LOGGER.info("Only cropping, script will not run BPM analyses")
+        save_cropped = True
     analysis_id = '_'.join([well_id, loop, channel]) 
 
+    # Cropped videos are written in the background. At most one write is pending, to cap memory.
+    writer = ThreadPoolExecutor(max_workers=1)
+    pending_write = None
+
+    # Waits for the pending write. Errors are logged for the well that was written, not the one being cropped.
+    def finish_write(pending_write):
+        if pending_write is None:
+            return
+
+        future, written_metadata = pending_write
+        try:
+            future.result()
+        except Exception:
+            LOGGER.exception("Problem while saving cropped video for well " + str(written_metadata['well_id'])
+                             + " in loop " + str(written_metadata['loop'])
+                             + " with channel " + str(written_metadata['channel']))
+
     resulting_dict_from_crop = {}
-    for well_frame_paths, video_metadata in io_operations.well_video_generator(indir, [channel], [loop]):
+    for well_frame_paths, video_metadata in io_operations.well_video_generator(indir, [channel], [loop], frame_index):
         
         # well_nr = int(video_metadata['well_id'][-3:])
         well_nr = video_metadata['well_id']
         if well_id is not None and well_nr != well_id:
             continue
+
+        if crop_bpm and (well_nr, video_metadata['loop'], video_metadata['channel']) in journal:
+            LOGGER.info(f'Well {well_nr} already analysed, taking result from the results journal')
+            io_operations.append_result(results, journal[(well_nr, video_metadata['loop'], video_metadata['channel'])])
+            continue
     
         try:
             LOGGER.info("Looking at video - "
@@ -70,25 +115,57 @@ def main(indir, outdir, well_id, loop, channel, args, debug=False):
             LOGGER.debug("Loading first 5 frames of video for embryo detection...")
             video8 = io_operations.load_video(well_frame_paths, imread_flag=1, max_frames=5)
             embryo_coordinates = cropping.embryo_detection(video8, embryo_size, border_ratio)
-            
-            # we need every image as 16 bits to crop based on video8 coordinates
-            LOGGER.debug("Loading video {}".format(str(video_metadata['well_id'])))            
-            video16 = io_operations.load_video(well_frame_paths, imread_flag=-1)
-            LOGGER.debug("Video successfully loaded")
-            cropped_video, resulting_dict_from_crop = cropping.crop_2(video16, embryo_size, embryo_coordinates, resulting_dict_from_crop, video_metadata)
-            
-            # save cropped images
-            LOGGER.debug('Saving cropped video in dir: ' + str(outdir / 'croppedRAWTiff/'))
-            io_operations.save_cropped(cropped_video, args, well_frame_paths)
+
+            cropped_video = None
+            if config['CROPPING'].getboolean('VIRTUAL_CROP'):
+                # Only store the embryo position. The heart rate analysis reads this region from the raw frames.
+                region = cropping.crop_limits(embryo_coordinates, embryo_size, video8.shape[1:3])
+                LOGGER.debug('Saving crop coordinates in dir: ' + str(outdir / io_operations.CROP_COORDINATES_DIR))
+                io_operations.save_crop_coordinates(args.outdir, video_metadata, region)
+                _, resulting_dict_from_crop = cropping.crop_2(video8[:1], embryo_size, embryo_coordinates, resulting_dict_from_crop, video_metadata)
+            else:
+                # we need every image as 16 bits to crop based on video8 coordinates
+                LOGGER.debug("Loading video {}".format(str(video_metadata['well_id'])))            
+                video16 = io_operations.load_video(well_frame_paths, imread_flag=-1)
+                LOGGER.debug("Video successfully loaded")
+                cropped_video, resulting_dict_from_crop = cropping.crop_2(video16, embryo_size, embryo_coordinates, resulting_dict_from_crop, video_metadata)
+                del video16
+                
+                # save cropped images
+                if save_cropped:
+                    finish_write(pending_write)
+                    LOGGER.debug('Saving cropped video in dir: ' + str(outdir / 'croppedRAWTiff/'))
+                    pending_write = (writer.submit(io_operations.save_cropped, cropped_video, args, well_frame_paths), video_metadata)
             
             # save panel for crop checking
             LOGGER.debug('Saving panel in dirs: ' + str(outdir / "*_panel.png"))
             io_operations.save_panel(resulting_dict_from_crop, args)
-        except:
-            LOGGER.error("Problem while cropping for well " + str(video_metadata['well_id'])
+
+            if crop_bpm:
+                # Analyse the cropped video as medaka_bpm.py would after reading the cropped frames (8 bit greyscale).
+                if cropped_video is None:
+                    video = io_operations.load_video(well_frame_paths, imread_flag=0, region=region)
+                else:
+                    video = io_operations.convert_imread_flag(np.asarray(cropped_video), imread_flag=0)
+                del cropped_video
+
+                io_operations.append_result(results, medaka_bpm.evaluate_well(well_frame_paths, video_metadata, args, trained_tree, video))
+        except Exception:
+            LOGGER.exception("Problem while cropping for well " + str(video_metadata['well_id'])
                         + " in loop " +
                         str(video_metadata['loop'])
                         + " with channel " + str(video_metadata['channel']))
+
+            # Failed wells are reported as medaka_bpm.py does, so results and journal list every well
+            if crop_bpm:
+                io_operations.append_result(results, medaka_bpm.failed_well_result(video_metadata, args, "Error during cropping. Check log files"))
+
+    # Wait for the cropped videos to be written
+    finish_write(pending_write)
+    writer.shutdown()
+
+    if crop_bpm and results:
+        io_operations.write_to_spreadsheet(Path(outdir / "results"), io_operations.results_frame(results), analysis_id)
     LOGGER.info("#######################\n")
             
         
@@ -137,6 +214,12 @@ if __name__ == '__main__':
                         dest='crop',
                         help='Crops images, does not analyze BPM',
                         required=False)
+
+    parser.add_argument('--crop_bpm',
+                        action="store_true",
+                        dest='crop_bpm',
+                        help='Crops images and analyzes BPM on the cropped videos in the same job',
+                        required=False)
     
     parser.add_argument('-s', '--embryo_size', 
                         help='radius of embryo in pixels',
@@ -160,6 +243,11 @@ if __name__ == '__main__':
                         help='maxjobs on the cluster',
                         required=False)
     
+    parser.add_argument('--resume',
+                        action="store_true",
+                        help='With --crop_bpm, skip wells already in the results journal of outdir',
+                        required=False)
+
     parser.add_argument('--debug',
                         action="store_true",
                         help='Additional debug output',
@@ -175,10 +263,13 @@ if __name__ == '__main__':
     args.loops =  list(args.loops)[0]
     args.channels =list(args.channels)[0]
 
+    # Scan the input directory only once for all wells
+    frame_index = io_operations.load_frame_index(args.indir, args.outdir)
+
     if args.well_id:
         analysis_id = '_'.join([args.well_id, args.loops, args.channels])
         setup.config_logger(os.path.join(args.outdir, 'log'), ("logfile_crop_{}.log".format(analysis_id)), args.debug)
-        main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=args.well_id, debug=args.debug, args=args)
+        main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=args.well_id, debug=args.debug, args=args, frame_index=frame_index)
         sys.exit(0)        
     elif args.well_array:
         range_wells = args.well_array[1:-1].split('-')        
@@ -196,19 +287,19 @@ if __name__ == '__main__':
         well_id = well_ls[job_index -1]
         analysis_id = '_'.join([well_id, args.loops, args.channels]) 
         setup.config_logger(os.path.join(args.outdir, 'log'), "logfile_crop_{}.log".format(analysis_id), args.debug)
-        main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=well_id, debug=args.debug, args=args)
+        main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=well_id, debug=args.debug, args=args, frame_index=frame_index)
     
     elif len(well_ls) == 1:
         analysis_id = '_'.join([well_ls[0], args.loops, args.channels]) 
         setup.config_logger(os.path.join(args.outdir, 'log'), "logfile_crop_{}.log".format(analysis_id), args.debug)
-        main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=well_ls[0], debug=args.debug, args=args)
+        main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=well_ls[0], debug=args.debug, args=args, frame_index=frame_index)
     else:
         #FIXME: Find a better way to run several wells at a time, multiprocesses ?
         for well_id in well_ls: 
             analysis_id = '_'.join([args.loops, args.channels]) 
             setup.config_logger(os.path.join(args.outdir, 'log'), "logfile_crop_{}.log".format(analysis_id), args.debug)
             try:
-                main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=well_id, debug=args.debug, args=args)
+                main(indir=Path(args.indir), outdir=Path(args.outdir), loop=args.loops, channel=args.channels, well_id=well_id, debug=args.debug, args=args, frame_index=frame_index)
             except Exception:
                 LOGGER.error('Error with well_id {}.'.format(well_id), exc_info=True)
                 pass      
@@ -17,8 +17,6 @@ from typing import Iterable, Union, Tuple
 import numpy as np
 import pandas as pd
 
-import matplotlib.pyplot as plt
-
 import sklearn
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.tree import DecisionTreeClassifier
@@ -42,7 +40,9 @@ def plot_qc_params(data: pd.DataFrame,
                    limits: Union[dict, None] = None,
                    figsize: tuple = (10, 30), 
                    save_q: bool = True) -> None:
-    
+    # Imported on use, evaluate() is called in every analysis process
+    import matplotlib.pyplot as plt
+
     fig, ax = plt.subplots(nrows = len(QC_FEATURES), 
                         figsize = figsize,
                         gridspec_kw = dict(left = 0.01, right = 0.9,
@@ -109,7 +109,9 @@ def plot_decision_tree(tree: sklearn.tree.DecisionTreeClassifier,
                        class_names: Iterable[str] = ["no_error", "error"],
                        figsize: tuple = (40, 30),
                        save_q = True) -> None:
-    
+    # Imported on use, evaluate() is called in every analysis process
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(figsize = figsize)
     _ = sklearn.tree.plot_tree(tree,
                            feature_names = feature_names,
@@ -0,0 +1,71 @@
+############################################################################################################
+# License: GNU GENERAL PUBLIC LICENSE Version 3
+###
+# Validation report for the PRECISION option of config.ini.
+# Runs the heart rate analysis on every well of indir with the spectral analysis in float64 and in float32 and
+# reports the drift of the BPM and of all qc attributes.
+# Usage: python qc_analysis/precision_report.py -i data/test_video -o precision_report
+###
+############################################################################################################
+import argparse
+import logging
+from pathlib import Path
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Imports from base dir of repository
+parent_dir = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(parent_dir))
+
+import src.io_operations    as io_operations
+import src.segment_heart    as segment_heart
+
+LOGGER = logging.getLogger(__name__)
+
+PRECISIONS = ('float64', 'float32')
+
+parser = argparse.ArgumentParser(description='Drift of BPM and qc attributes between float64 and float32 spectral analysis')
+parser.add_argument('-i', '--indir',  help='Input directory',                     default=parent_dir / 'data' / 'test_video')
+parser.add_argument('-o', '--outdir', help='Output directory of the report',      default='precision_report')
+parser.add_argument('-f', '--fps',    help='Frames per second', type=float,       default=0.0)
+args = parser.parse_args()
+
+args.indir  = Path(args.indir)
+args.outdir = Path(args.outdir)
+args.outdir.mkdir(parents=True, exist_ok=True)
+
+logging.basicConfig(level=logging.WARNING)
+
+rows = []
+for well_frame_paths, video_metadata in io_operations.well_video_generator(args.indir, *io_operations.extract_data(args.indir)[1:3]):
+    well = '_'.join([video_metadata['well_id'], video_metadata['loop'], video_metadata['channel']])
+    video = io_operations.load_video(well_frame_paths, imread_flag=0)
+
+    results = {}
+    for precision in PRECISIONS:
+        segment_heart.config['ANALYSIS']['PRECISION'] = precision
+
+        metadata = dict(video_metadata, timestamps=io_operations.extract_timestamps(well_frame_paths))
+        run_args = {'outdir': args.outdir / precision, 'fps': args.fps}
+        bpm, fps, qc_attributes = segment_heart.run(video.copy(), run_args, metadata)
+        results[precision] = dict(qc_attributes, bpm=bpm)
+
+    for attribute, reference in results['float64'].items():
+        value = results['float32'].get(attribute)
+        try:
+            reference, value = float(reference), float(value)
+            abs_drift = abs(value - reference)
+            rel_drift = abs_drift / abs(reference) if reference else np.nan
+        except (TypeError, ValueError):
+            abs_drift = rel_drift = np.nan
+
+        rows.append({'well': well, 'attribute': attribute, 'float64': reference, 'float32': value,
+                     'abs drift': abs_drift, 'rel drift': rel_drift})
+
+report = pd.DataFrame(rows)
+report.to_csv(args.outdir / 'precision_report.csv', index=False)
+
+with pd.option_context('display.max_rows', None, 'display.width', 200, 'display.float_format', '{:.6g}'.format):
+    print(report.to_string(index=False))
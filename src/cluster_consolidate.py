@@ -1,19 +1,22 @@
 #!/usr/bin/env python
 ############################################################################################################
-# Authors: 
+# Authors:
 #   Marcio Ferreira,    EMBL-EBI,       marcio@ebi.ac.uk
 #   Sebastian Stricker, Uni Heidelberg, sebastian.stricker@stud.uni-heidelberg.de
 # Date: 08/2021
 # License: GNU GENERAL PUBLIC LICENSE Version 3
 ###
-# For cluster mode.
-# Each node creates it's own results file in outdir/tmp.
-# Called as a dependend bsub job when all instances running cluster.py have finished.
-# Gathers data from outdir/tmp and creates the final report.
+# For cluster and multi-process mode.
+# Each job appends the result of every analysed well to the results journal in indir/results.
+# Called as a dependend job when all analysis jobs have finished, but can be run at any time during the
+# analysis to get the results of the wells finished so far.
+# Consolidation is incremental: the journal is read from where the last consolidation stopped, merged into the
+# consolidation state and the final report is rewritten from it.
 ###
 ############################################################################################################
 import argparse
-import pandas as pd
+import json
+import shutil
 from pathlib import Path
 import logging
 import os
@@ -22,6 +25,13 @@ import setup
 
 LOGGER = logging.getLogger(__name__)
 
+# Merged results and read position in the journal, kept between consolidations. Stored in indir/results.
+CONSOLIDATION_STATE = 'consolidation_state.json'
+
+# Logs of the analysis jobs, gathered in one file in outdir/log
+ANALYSIS_LOGS = ('logfile_hrt_bpm*.log', 'logfile_crop_*.log')
+CONSOLIDATED_LOG = 'logfile_analyses.log'
+
 parser = argparse.ArgumentParser(description='Read in medaka heart video frames')
 parser.add_argument('-o','--outdir', action="store", dest='outdir', help='Where to store the output report and the global log',    default=False, required = True)
 parser.add_argument('-i','--indir', action="store", dest='indir', help='Path to temp folder with results', default=False, required = True)
@@ -36,54 +46,76 @@ experiment_id = args.outdir.name.split('_')[0]
 
 setup.config_logger( os.path.join(str(args.outdir), 'log'), "logfile_consolidate.log", args.debug)
 
+# Consolidation state of the last run. Starts over if the journal was replaced in the meantime.
+def load_state(state_path, journal_path):
+    state = {'offset': 0, 'results': {}}
+    if state_path.is_file():
+        with open(state_path) as fp:
+            state = json.load(fp)
+
+    if state['offset'] > journal_path.stat().st_size:
+        LOGGER.warning("Results journal is shorter than at the last consolidation. Consolidating from scratch")
+        state = {'offset': 0, 'results': {}}
+
+    return state
+
+def save_state(state_path, state):
+    tmp_path = state_path.with_name(f"{state_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'w') as fp:
+        json.dump(state, fp)
+    os.replace(tmp_path, state_path)
+
+# Concatenates the logs of all analysis jobs into one file, copied file to file.
+def consolidate_logs(logs_dir, outpath):
+    logs_paths = sorted({path for pattern in ANALYSIS_LOGS for path in logs_dir.glob(pattern)})
+    LOGGER.debug('{} Logs paths found'.format(len(logs_paths)))
+
+    tmp_path = outpath.with_name(f"{outpath.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as out:
+        for log in logs_paths:
+            out.write(f"##### {log.name} #####\n".encode())
+            with open(log, 'rb') as fp:
+                shutil.copyfileobj(fp, out)
+            out.write(b'\n')
+    os.replace(tmp_path, outpath)
+
 try:
     LOGGER.info("Consolidating cluster results")
 
-    # path to central log file
-    logs_paths    = list((args.indir / 'log').glob('logfile_hrt_bpm*.log'))
-    results_paths = list((args.indir / 'results').glob('*.csv'))
-    
-    LOGGER.debug('{} Logs paths found'.format(len(logs_paths)))
-    LOGGER.debug('{} Results paths found'.format(len(results_paths)))
-
-    # log files and results files of one analysis should have same index in lists
-    logs_paths.sort()
-    results_paths.sort()
-
-    results = pd.DataFrame()
-    
-    # Extract data from all files in tmp dir into dataframe
-    for log, result in zip(logs_paths, results_paths):
-        well_result = {}
-        if (Path(log).stem.split('-') != Path(result).stem.split('-')):
-            LOGGER.exception("Logfile and result file order not right")
-
-        with open(log) as fp:
-            log_text = fp.read()
-            well_result['log'] = log_text
-        
-        # File stores column name and value in the following format
-        # (cluster.py) out_string = "heartbeat:123;Heart Size:1110;HROI count:2; ..."
-        with open(result) as fp:
-            out_string = fp.read()
-            fields = out_string.split(';')
-            for field in fields:
-                entry = field.split(':')
-                well_result[entry[0]] = entry[1]
-
-        results = results.append(well_result, ignore_index=True)
+    results_dir  = args.indir / 'results'
+    journal_path = results_dir / io_operations.RESULTS_JOURNAL
+    state_path   = results_dir / CONSOLIDATION_STATE
+
+    if not journal_path.is_file():
+        raise FileNotFoundError("No results journal found in " + str(results_dir))
+
+    # Merge the entries added since the last consolidation. A rerun of a well replaces its earlier result.
+    state = load_state(state_path, journal_path)
+    nr_new_entries = 0
+    for entry, offset in io_operations.read_journal_entries(journal_path, state['offset']):
+        entry.pop('config_hash', None)
+        state['results']['-'.join([entry['well_id'], entry['loop'], entry['channel']])] = entry
+        state['offset'] = offset
+        nr_new_entries += 1
+
+    save_state(state_path, state)
+    LOGGER.debug('{} new results, {} wells in total'.format(nr_new_entries, len(state['results'])))
+
+    # One list per column. See io_operations.append_result()
+    results = {}
+    for well_result in state['results'].values():
+        io_operations.append_result(results, well_result)
 
     # Sort entries for output
-    results = pd.DataFrame.from_dict(results)
-    results = results.sort_values(by=['Channel', 'Loop', 'WellID'])
+    results = io_operations.results_frame(results)
+    results = results.sort_values(by=['channel', 'loop', 'well_id'], ignore_index=True)
 
-    # Consolidate all logs into the general log file
-    logs = results['log'].tolist()
-    LOGGER.info("Log reports from analyses: \n" + '\n'.join(logs))
+    # Consolidate all logs into one log file, next to the consolidation log
+    consolidate_logs(args.indir / 'log', args.outdir / 'log' / CONSOLIDATED_LOG)
+    LOGGER.info("Log reports from analyses in: " + str(args.outdir / 'log' / CONSOLIDATED_LOG))
 
-    # Logs should not appear in the output csv
-    results = results.drop(columns=['log'])
-    io_operations.write_to_spreadsheet(args.outdir, results, experiment_id)
+    # Rewritten on every consolidation, holds the results of all wells finished so far
+    io_operations.write_to_spreadsheet(args.outdir, results, experiment_id, overwrite=True)
 
 except Exception as e:
-    LOGGER.exception("Couldn't consolidate results from cluster analysis")
\ No newline at end of file
+    LOGGER.exception("Couldn't consolidate results from cluster analysis")
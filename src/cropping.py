@@ -112,16 +112,22 @@ def embryo_detection(video, embryo_size=450, border_ratio=0.15):
 
     return XY_average
 
+# Bounding box of the embryo, limited to the image borders. Returns [y_start, y_stop], [x_start, x_stop]
+def crop_limits(embryo_coordinates, embryo_size, image_shape):
+    x_lim = [int(embryo_coordinates[0])-embryo_size, int(embryo_coordinates[0])+embryo_size]
+    x_lim = [max(0, x_lim[0]), min(image_shape[1], x_lim[1])]
+
+    y_lim = [int(embryo_coordinates[1])-embryo_size, int(embryo_coordinates[1])+embryo_size]
+    y_lim = [max(0, y_lim[0]), min(image_shape[0], y_lim[1])]
+
+    return y_lim, x_lim
+
 def crop_2(video, embryo_size, embryo_coordinates, resulting_dict_from_crop, video_metadata):
     video_cropped = []
 
     for index, img in enumerate(video):
         try:
-            x_lim = [int(embryo_coordinates[0])-embryo_size, int(embryo_coordinates[0])+embryo_size]
-            x_lim = [max(0, x_lim[0]), min(img.shape[1], x_lim[1])]
-
-            y_lim = [int(embryo_coordinates[1])-embryo_size, int(embryo_coordinates[1])+embryo_size]
-            y_lim = [max(0, y_lim[0]), min(img.shape[0], y_lim[1])]
+            y_lim, x_lim = crop_limits(embryo_coordinates, embryo_size, img.shape)
 
             cut_image = img[y_lim[0]: y_lim[1], x_lim[0]: x_lim[1]]
            
@@ -9,16 +9,27 @@
 ###
 ############################################################################################################
 import logging
+import os
 from pathlib import Path
 import pathlib
 import pickle
-import glob
+import json
+import hashlib
 import cv2
+import tifffile
 import numpy as np
+import pandas as pd
 import re
-import itertools
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from matplotlib import pyplot as plt
+# File locking of the results journal. Not available on Windows, appends are atomic there for single writes.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import configparser
 
@@ -32,36 +43,151 @@ config.read(config_path)
 logging.getLogger('matplotlib.font_manager').disabled = True
 LOGGER = logging.getLogger(__name__)
 
-# Goes through all channels and loops and yields well data fields and paths to frames sorted by frame index.
-def well_video_generator(indir, channels, loops):
-    # -A001--PO01--LO001--CO1--SL001--PX32500--PW0070--IN0020--TM280--X014600--Y011401--Z214683--T0000000000--WE00001.tif
+# Manifest of the frame index, stored in the output directory. See load_frame_index()
+MANIFEST_NAME = 'frame_manifest.npz'
+MANIFEST_MIN_AGE = 2 # seconds
+
+# Marks multi-page TIFFs holding the whole video of a well. Replaces the SL frame index in the file name.
+STACK_MARKER = '-SLSTACK'
+
+# Per well results, appended as JSON lines in outdir/results. See append_to_journal()
+RESULTS_JOURNAL = 'results_journal.jsonl'
+
+# Embryo bounding boxes of virtual cropping, stored in the output directory. See save_crop_coordinates()
+CROP_COORDINATES_DIR = 'crop_coordinates'
+
+# Fields of the frame index. See index_directory()
+FRAME_INDEX_FIELDS = ('name', 'channel', 'loop', 'well_id', 'frame', 'timestamp', 'x', 'y', 'z', 'stack')
+
+# Fields encoded in the frame file names, parsed once per directory by index_directory().
+# -A001--PO01--LO001--CO1--SL001--PX32500--PW0070--IN0020--TM280--X014600--Y011401--Z214683--T0000000000--WE00001.tif
+FRAME_NAME_PATTERNS = { 'well_id'   : re.compile(r'WE\d{5}'),
+                        'loop'      : re.compile(r'-(LO\d{3})'),
+                        'channel'   : re.compile(r'-(CO\d)'),
+                        'frame'     : re.compile(r'-SL(\d+)'),
+                        'timestamp' : re.compile(r'-T(\d{1,10})'),
+                        'x'         : re.compile(r'-X(\d+)'),
+                        'y'         : re.compile(r'-Y(\d+)'),
+                        'z'         : re.compile(r'-Z(\d+)')}
+
+# Builds an index of all frames in a directory with a single scandir pass.
+# Returns a numpy record array with one entry per frame, sorted by channel, loop, well and frame index.
+#   fields: name, channel, loop, well_id, frame (SL), timestamp (T), x, y, z
+#   stack: multi-page TIFF holding the whole video of a well (see save_cropped)
+# Numeric fields missing from a file name are set to -1. Files without well, loop, channel or frame index are ignored.
+def index_directory(indir):
+    LOGGER.debug("Indexing frames in " + str(indir))
+    records = []
+    with os.scandir(indir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(('.tif', '.tiff')) or not entry.is_file():
+                continue
+
+            fields = {key: pattern.search(entry.name) for key, pattern in FRAME_NAME_PATTERNS.items()}
+            is_stack = is_video_stack(entry.name)
+            if not all(fields[key] for key in ['well_id', 'loop', 'channel']) or not (fields['frame'] or is_stack):
+                LOGGER.debug("Skipping file with unknown name format: " + entry.name)
+                continue
+
+            records.append((entry.name,
+                            fields['channel'].group(1),
+                            fields['loop'].group(1),
+                            fields['well_id'].group(0),
+                            1 if is_stack else int(fields['frame'].group(1)), # Stacks hold the whole video, starting at SL001
+                            *[int(fields[key].group(1)) if fields[key] else -1 for key in ['timestamp', 'x', 'y', 'z']],
+                            is_stack))
+
+    name_length = max([len(record[0]) for record in records], default=1)
+    dtype = [('name', f'U{name_length}'), ('channel', 'U3'), ('loop', 'U5'), ('well_id', 'U7'),
+             ('frame', np.int32), ('timestamp', np.int64), ('x', np.int64), ('y', np.int64), ('z', np.int64),
+             ('stack', bool)]
+
+    frame_index = np.array(records, dtype=dtype)
+    frame_index.sort(order=['channel', 'loop', 'well_id', 'frame', 'name'])
+
+    LOGGER.debug("Indexed " + str(len(frame_index)) + " frames")
+    return frame_index.view(np.recarray)
+
+# Loads the frame index of indir from the manifest in outdir, or builds and stores it if the manifest is missing or outdated.
+# The manifest is keyed by the directory mtime and the number of indexed frames. Adding or removing frames changes the mtime
+# of the directory, which invalidates the manifest automatically.
+# Cluster array tasks and reruns sharing an outdir can thereby skip listing the experiment folder.
+def load_frame_index(indir, outdir=None):
+    if outdir is None:
+        return index_directory(indir)
+
+    indir = Path(indir).resolve()
+    manifest_path = Path(outdir) / MANIFEST_NAME
+    dir_mtime = os.stat(indir).st_mtime_ns
+
+    try:
+        with np.load(manifest_path) as manifest:
+            # Adding, removing or renaming frames changes the mtime of the directory
+            if str(manifest['indir']) == str(indir) and int(manifest['mtime']) == dir_mtime:
+                frame_index = manifest['frame_index']
+
+                # Manifests of older versions may lack fields
+                if frame_index.dtype.names == FRAME_INDEX_FIELDS:
+                    LOGGER.debug("Loaded frame index of " + str(len(frame_index)) + " frames from " + str(manifest_path))
+                    return frame_index.view(np.recarray)
+    except (OSError, KeyError, ValueError):
+        pass
+
+    frame_index = index_directory(indir)
+
+    # Directories with coarse mtime resolution could still receive frames within the same tick.
+    # Don't persist an index of a folder that was modified just now.
+    if (time.time_ns() - dir_mtime) < MANIFEST_MIN_AGE * 1e9:
+        return frame_index
+
+    # Write to a temporary file first, so parallel jobs never read a partially written manifest.
+    try:
+        Path(outdir).mkdir(parents=True, exist_ok=True)
+        tmp_path = manifest_path.with_name(f"{manifest_path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, frame_index=np.asarray(frame_index), indir=str(indir), mtime=dir_mtime)
+        os.replace(tmp_path, manifest_path)
+        LOGGER.debug("Saved frame index manifest to " + str(manifest_path))
+    except OSError:
+        LOGGER.warning("Could not save frame index manifest to " + str(manifest_path))
+
+    return frame_index
+
+# Select the entries of a frame index matching all given fields.
+def query_frame_index(frame_index, channel=None, loop=None, well_id=None, frame=None):
+    mask = np.ones(len(frame_index), dtype=bool)
+    for field, value in [('channel', channel), ('loop', loop), ('well_id', well_id), ('frame', frame)]:
+        if value is not None:
+            mask &= (frame_index[field] == value)
+
+    return frame_index[mask]
 
-    # Grab all paths to all frames
-    all_frames = list(indir.glob('*.tif')) + list(indir.glob('*.tiff'))
+# Goes through all channels and loops and yields well data fields and paths to frames sorted by frame index.
+def well_video_generator(indir, channels, loops, frame_index=None):
+    if frame_index is None:
+        frame_index = index_directory(indir)
 
     # Channel
     for channel in channels:
-        channel_videos = [frame for frame in all_frames if channel in frame.name]
+        channel_frames = query_frame_index(frame_index, channel=channel)
         # Loop
         for loop in loops:
-            loop_videos = [frame for frame in channel_videos if loop in frame.name]
+            loop_frames = query_frame_index(channel_frames, loop=loop)
 
             # Well
-            for well_id in range(1, 97):
-                well_id = ('WE00' + '{:03d}'.format(well_id))
+            # The index is sorted, the frames of a well are therefore contiguous and in the correct order.
+            well_ids, well_starts = np.unique(loop_frames.well_id, return_index=True)
+            well_stops = list(well_starts[1:]) + [len(loop_frames)]
+            for well_id, well_start, well_stop in zip(well_ids, well_starts, well_stops):
+                well_frames = loop_frames[well_start:well_stop]
 
-                well_frames = [frame for frame in loop_videos if well_id in frame.name]
+                # A stack holds the whole video. It takes precedence over single frames of the same well.
+                if np.any(well_frames.stack):
+                    well_frames = well_frames[well_frames.stack][:1]
 
-                # Skipping costs (close to) no time and the logic is simpler than extracting the exact set of wells per loop/channel.
-                # Could be solved cleaner though.
-                if not well_frames:
-                    continue
+                well_frames_sorted = [indir / name for name in well_frames.name]
 
-                # Sort frames in correct order
-                frame_indices = [frameIdx(path.name) for path in well_frames]
-                _, well_frames_sorted = (list(t) for t in zip(*sorted(zip(frame_indices, well_frames))))
-
-                metadata = {'well_id': well_id, 'loop': loop, 'channel': channel}
+                metadata = {'well_id': str(well_id), 'loop': loop, 'channel': channel}
                 yield well_frames_sorted, metadata
 
 
@@ -102,67 +228,305 @@ def load_decision_tree():
 #   -1  - as is (greyscale 16bit)
 #   0   - greyscale 8 bit
 #   1   - color     8 bit
-def load_video(frame_paths, imread_flag=0, max_frames=np.inf):
+# Frames are decoded concurrently on a bounded thread pool (cv2.imread releases the GIL)
+# and written straight into the preallocated video array.
+# region: Only load this sub-region of the frames ([y_start, y_stop], [x_start, x_stop]), e.g. from a virtual crop.
+def load_video(frame_paths, imread_flag=0, max_frames=np.inf, workers=None, region=None):
     LOGGER.debug("Loading video...")
-    test_frame = cv2.imread(frame_paths[0], imread_flag)
+    if len(frame_paths) == 1 and is_video_stack(frame_paths[0]):
+        video = load_video_stack(frame_paths[0], imread_flag, max_frames)
+        if region is not None:
+            (y_start, y_stop), (x_start, x_stop) = region
+            video = video[:, y_start:y_stop, x_start:x_stop]
+        return video
+
+    def imread(path):
+        if region is None:
+            return cv2.imread(path, imread_flag)
+        return read_frame_region(path, imread_flag, region)
+
+    test_frame = imread(frame_paths[0])
+
+    nr_of_frames = int(min(len(frame_paths), max_frames))
+    video = np.empty(shape=(nr_of_frames, *test_frame.shape), dtype=test_frame.dtype)
+    video[0] = test_frame
+
+    def read_frame(i):
+        frame = imread(frame_paths[i])
+        if frame is None:
+            raise IOError("Could not read frame " + str(frame_paths[i]))
+        video[i] = frame
 
-    video = np.empty(shape=(len(frame_paths), *test_frame.shape), dtype=test_frame.dtype)
-    for i, path in enumerate(frame_paths):
-        if i >= max_frames:
-            break
+    if workers is None:
+        workers = config['IO'].getint('LOAD_THREADS')
+        # Thread budget of the process, see job_utils.limit_threads()
+        workers = min(workers, int(os.environ.get('MEDAKA_THREADS', workers)))
+    workers = max(1, min(workers, nr_of_frames - 1))
 
+    if workers == 1:
+        for i in range(1, nr_of_frames):
+            read_frame(i)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Consume results to propagate exceptions of the worker threads
+            list(executor.map(read_frame, range(1, nr_of_frames)))
+
+    return video
+
+# Converts greyscale frames read as is to what cv2.imread would return for imread_flag.
+def convert_imread_flag(frames, imread_flag):
+    if imread_flag >= 0:
+        if frames.dtype == np.uint16:
+            frames = (frames >> 8).astype(np.uint8)
+        if imread_flag == 1:
+            frames = np.repeat(frames[..., np.newaxis], 3, axis=-1)
+
+    return frames
+
+# Reads a sub-region of a frame. Only the strips containing the region's rows are read and decoded.
+# Falls back to decoding the whole frame with OpenCV, if the TIFF layout or compression doesn't allow partial reads.
+def read_frame_region(path, imread_flag, region):
+    (y_start, y_stop), (x_start, x_stop) = region
+    try:
+        frame_rows = read_tiff_rows(path, y_start, y_stop)
+        return convert_imread_flag(frame_rows[:, x_start:x_stop], imread_flag)
+    except (ValueError, KeyError, NotImplementedError):
         frame = cv2.imread(path, imread_flag)
-        video[i] = frame
-    return np.asarray(video)
+        return frame[y_start:y_stop, x_start:x_stop]
+
+def read_tiff_rows(path, y_start, y_stop):
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        # Tiled TIFFs have no strips (rowsperstrip is 0)
+        if page.is_tiled or not page.rowsperstrip or page.samplesperpixel != 1:
+            raise ValueError("TIFF layout does not allow strip-wise reading: " + str(path))
+
+        nr_of_strips = -(-page.imagelength // page.rowsperstrip)
+        if len(page.dataoffsets) != nr_of_strips:
+            raise ValueError("TIFF layout does not allow strip-wise reading: " + str(path))
+
+        first_strip = y_start // page.rowsperstrip
+        last_strip  = (y_stop - 1) // page.rowsperstrip
+
+        strips = []
+        for index in range(first_strip, last_strip + 1):
+            tif.filehandle.seek(page.dataoffsets[index])
+            data = tif.filehandle.read(page.databytecounts[index])
+            strip, _, _ = page.decode(data, index)
+            strips.append(strip.reshape(-1, page.imagewidth))
+
+    rows = np.concatenate(strips)
+    row_offset = first_strip * page.rowsperstrip
+    return rows[y_start - row_offset : y_stop - row_offset]
+
+def is_video_stack(path):
+    return STACK_MARKER in Path(path).name
+
+# Reads a multi-page TIFF written by save_cropped(). Converts frames like cv2.imread would for the given imread_flag.
+def load_video_stack(stack_path, imread_flag=0, max_frames=np.inf):
+    with tifffile.TiffFile(stack_path) as tif:
+        nr_of_frames = int(min(len(tif.pages), max_frames))
+        video = tif.asarray(key=range(nr_of_frames))
+        video = video.reshape(nr_of_frames, *tif.pages[0].shape)
+
+    # Color stacks are not written by save_cropped, frames are greyscale.
+    return convert_imread_flag(video, imread_flag)
+
+# Frame names, SL indices and timestamps of the frames in a stack, stored in its tags.
+def stack_frame_metadata(stack_path):
+    with tifffile.TiffFile(stack_path) as tif:
+        return tif.shaped_metadata[0]
+
+# Opt-in cache of decoded videos, enabled by setting VIDEO_CACHE_DIR in the config.
+# Each video is stored once as .npy file and memory mapped (read-only) on later runs instead of decoding all frames again.
+# The key is built from the frame list, the imread flag, the loaded region and the modification times of the first and last frame.
+# Least recently used videos are removed once the cache exceeds VIDEO_CACHE_SIZE_GB.
+def load_cached_video(frame_paths, imread_flag=0, region=None):
+    cache_dir = config['IO'].get('VIDEO_CACHE_DIR', '').strip()
+    if not cache_dir:
+        return load_video(frame_paths, imread_flag, region=region)
+
+    cache_dir = Path(cache_dir)
+    cache_path = cache_dir / (video_cache_key(frame_paths, imread_flag, region) + '.npy')
+
+    try:
+        video = np.load(cache_path, mmap_mode='r')
+        # Mark as recently used for the eviction
+        os.utime(cache_path)
+        LOGGER.debug("Loaded video from cache " + str(cache_path))
+        return video
+    except (OSError, ValueError):
+        pass
+
+    video = load_video(frame_paths, imread_flag, region=region)
+
+    # Write to a temporary file first, parallel processes may read the cache at the same time.
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.stem}.{os.getpid()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, video)
+        os.replace(tmp_path, cache_path)
+        LOGGER.debug("Saved video to cache " + str(cache_path))
+
+        max_size = config['IO'].getfloat('VIDEO_CACHE_SIZE_GB') * 1024**3
+        evict_video_cache(cache_dir, max_size)
+    except OSError:
+        LOGGER.warning("Could not write video to cache " + str(cache_dir), exc_info=True)
+
+    return video
+
+def video_cache_key(frame_paths, imread_flag, region=None):
+    first_frame, last_frame = os.stat(frame_paths[0]), os.stat(frame_paths[-1])
+
+    key = hashlib.sha1()
+    key.update(str(imread_flag).encode())
+    key.update(str(region).encode())
+    key.update(f"{first_frame.st_mtime_ns}:{last_frame.st_mtime_ns}".encode())
+    for path in frame_paths:
+        key.update(os.path.abspath(path).encode())
+
+    return key.hexdigest()
+
+# Removes least recently used videos until the cache is smaller than max_size (bytes).
+def evict_video_cache(cache_dir, max_size):
+    cached_videos = []
+    for path in Path(cache_dir).glob('*.npy'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError: # Removed by another process
+            continue
+        cached_videos.append((stat.st_mtime, stat.st_size, path))
+
+    cached_videos.sort()
+    cache_size = sum([size for _, size, _ in cached_videos])
+
+    for _, size, path in cached_videos:
+        if cache_size <= max_size:
+            break
+        try:
+            path.unlink()
+            LOGGER.debug("Removed video from cache " + str(path))
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+# Producer/consumer pipeline: decodes the next videos of well_videos in a background thread while the caller analyses the current one.
+# The producer only starts decoding a video once a slot is free, so at most depth + 1 videos are in memory:
+# the one the caller works on and up to 'depth' loaded or being loaded ahead of it.
+# Yields frame paths, metadata and the video. If loading a video failed, the exception is yielded in place of the video.
+def prefetch_videos(well_videos, imread_flag=0, depth=1):
+    if depth < 1:
+        for frame_paths, metadata in well_videos:
+            try:
+                video = load_cached_video(frame_paths, imread_flag, metadata.get('crop_region'))
+            except Exception as e:
+                video = e
+            yield frame_paths, metadata, video
+        return
+
+    video_queue = queue.Queue(maxsize=depth)
+    free_slots = threading.Semaphore(depth + 1)
+    stop_loading = threading.Event()
+    end_of_videos = object()
+
+    # Blocks until the consumer is done with a video, unless it stopped.
+    def acquire_slot():
+        while not stop_loading.is_set():
+            if free_slots.acquire(timeout=1):
+                return True
+        return False
+
+    # Blocks while the queue is full, unless the consumer stopped.
+    def put(item):
+        while not stop_loading.is_set():
+            try:
+                video_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for frame_paths, metadata in well_videos:
+                if not acquire_slot():
+                    return
+                try:
+                    video = load_cached_video(frame_paths, imread_flag, metadata.get('crop_region'))
+                except Exception as e:
+                    video = e
+
+                if not put((frame_paths, metadata, video)):
+                    return
+            put((end_of_videos, None, None))
+        except Exception as e:
+            # Failure of the video generator itself. Raised in the consumer thread.
+            put((end_of_videos, None, e))
+
+    loader = threading.Thread(target=producer, name="video_prefetch", daemon=True)
+    loader.start()
+
+    try:
+        while True:
+            frame_paths, metadata, video = video_queue.get()
+            if frame_paths is end_of_videos:
+                if video is not None:
+                    raise video
+                break
+            yield frame_paths, metadata, video
+            # The caller is done with the video
+            video = None
+            free_slots.release()
+    finally:
+        stop_loading.set()
 
 def extract_timestamps(sorted_frame_paths):
+    if len(sorted_frame_paths) == 1 and is_video_stack(sorted_frame_paths[0]):
+        return stack_frame_metadata(sorted_frame_paths[0])['timestamps']
+
     # splits every path at '-T'. Picks first 10 chars of the string that starts with a number.
     timestamps = [[s for s in path.name.split('-T') if s[0].isdigit()][-1][0:10] for path in sorted_frame_paths]
     return timestamps
 
 # Get metadata about the directory that is read in
 # Number of videos and channels and loops present.
-def extract_data(indir, channel_ls=[], loop_ls=[], well_range=''):
+def extract_data(indir, channel_ls=[], loop_ls=[], well_range='', frame_index=None):
     # -A001--PO01--LO001--CO1--SL001--PX32500--PW0070--IN0020--TM280--X014600--Y011401--Z214683--T0000000000--WE00001.tif
     LOGGER.info("### Extracting data from image names ###")
     LOGGER.debug("The input directory is " + str(indir))
 
+    if frame_index is None:
+        frame_index = index_directory(indir)
+
     # Grab first frame of all videos 
     if well_range != '[1-96]':
         pattern_well = re.findall('[\d]+', well_range)
         if len(pattern_well) == 2: pattern_well = list(range(int(pattern_well[0]), int(pattern_well[1]) +1, 1))     
-        well_ls = ['WE000'+ str(w) if len(str(w)) == 2 else 'WE0000' + str(w) for w in pattern_well]
+        well_ls = ['WE{:05d}'.format(int(w)) for w in pattern_well]
     else:
         well_ls = []
-    
-    if len(loop_ls + well_ls + channel_ls) > 0:
-        pattern_ls = ['*'.join(i) for i in itertools.product(loop_ls, channel_ls, ['SL001'], well_ls, ['.tif', '*.tiff'])]
-        LOGGER.debug('Several filtering '  + str(indir / pattern_ls[0]))
-        tiffs = [file for pattern in pattern_ls for file in indir / '/*' + pattern]
-    else:
-        pattern = '*SL001*.[tif tiff]*'
-        LOGGER.debug('No filtering: '  + str(indir / pattern))
-        tiffs = glob.glob(str(indir / pattern))
-        
-    
-    nr_of_videos = len(list(tiffs))
+
+    tiffs = query_frame_index(frame_index, frame=1)
+    for field, values in [('loop', loop_ls), ('channel', channel_ls), ('well_id', well_ls)]:
+        if len(values) > 0:
+            LOGGER.debug('Filtering ' + field + ': ' + ', '.join(values))
+            tiffs = tiffs[np.isin(tiffs[field], list(values))]
+
+    nr_of_videos = len(tiffs)
     LOGGER.debug('No of video found: '  + str(nr_of_videos))
 
-    if (not tiffs) or (nr_of_videos == 0):
+    if nr_of_videos == 0:
         raise ValueError("Could not find any tiffs inside " + str(indir))
 
     # Extract different channels
     # using a set, gives only unique values
-    channels = {'CO' + tiff.split('-CO')[-1][0] for tiff in tiffs}
-    channels = sorted(list(channels))
+    channels = sorted({str(channel) for channel in tiffs.channel})
 
     # Extract different Loops
-    # using a set, gives only unique values
-    loops = {'LO' + tiff.split('-LO')[-1][0:3] for tiff in tiffs}
-    loops = sorted(list(loops))
+    loops = sorted({str(loop) for loop in tiffs.loop})
 
-    wells = {re.findall('WE0\d{4}', tiff)[0] for tiff in tiffs}
-    wells = sorted(list(wells))   
+    wells = sorted({str(well) for well in tiffs.well_id})
     return nr_of_videos, channels, loops, wells
 
 # From Tim-script
@@ -172,35 +536,140 @@ def frameIdx(path):
     idx = int(idx)
     return idx
 
-def well_video_exists(indir, channel, loop, well_id):
-    all_frames = list(indir.glob('*.tif')) + list(indir.glob('*.tiff'))
-    video_frames = [frame for frame in all_frames
-                    if (channel in frame and 
-                        loop    in frame and 
-                        well_id in frame)]
+def well_video_exists(indir, channel, loop, well_id, frame_index=None):
+    if frame_index is None:
+        frame_index = index_directory(indir)
+
+    video_frames = query_frame_index(frame_index, channel=channel, loop=loop, well_id=well_id)
+    return len(video_frames) > 0
+
+# Adds a result row to results, which holds one list per column. Results are collected column-wise and turned
+# into a DataFrame once at the end with results_frame(), instead of concatenating a DataFrame per row.
+# Columns missing in the row, or new in it, are filled with None.
+def append_result(results, row):
+    nr_rows = max((len(values) for values in results.values()), default=0)
+    for column, value in row.items():
+        if column not in results:
+            results[column] = [None] * nr_rows
+        results[column].append(value)
+    for values in results.values():
+        if len(values) == nr_rows:
+            values.append(None)
+
+# DataFrame of the results collected with append_result()
+def results_frame(results):
+    return pd.DataFrame(results)
+
+# Hash of the settings that change the analysis results: the ANALYSIS section of the config, the decision tree
+# and the fps argument. Output and job settings, like saving the cropped videos or memory, are left out, as they are
+# typically changed for a resumed run. Stored with every journal entry, so results of other settings are not resumed.
+def settings_hash(args):
+    settings = {key: config['ANALYSIS'][key] for key in config['ANALYSIS'] if key not in config.defaults()}
+    settings['DECISION_TREE_PATH'] = config['DEFAULT']['DECISION_TREE_PATH']
+    settings['fps'] = vars(args).get('fps')
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+def journal_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+# Appends the result of a well to the journal as one line. The line is written with a single O_APPEND write under
+# an exclusive lock and synced to disk, so parallel processes sharing outdir do not interleave and a crash loses
+# at most the well in progress.
+def append_to_journal(outdir, well_result, settings_id):
+    entry = dict(well_result, config_hash=settings_id)
+    line = (json.dumps(entry, default=journal_value) + '\n').encode()
+
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    fd = os.open(Path(outdir) / RESULTS_JOURNAL, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+        # Start a new line if a crashed process left an incomplete one
+        size = os.fstat(fd).st_size
+        if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+            line = b'\n' + line
+
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        if fcntl:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+# Reads the entries of a results journal, starting at byte offset. Yields each entry with the offset after its line,
+# which can be stored to continue reading from there later. A last line without newline is still being written and
+# is left for the next read.
+def read_journal_entries(journal_path, offset=0):
+    with open(journal_path, 'rb') as fp:
+        fp.seek(offset)
+        for line in fp:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Line cut off by a crash
+                LOGGER.warning("Skipping incomplete entry in results journal " + str(journal_path))
+                continue
+
+            yield entry, offset
+
+# Results of the journal in outdir, for the current software version and the given settings.
+# Returns a dict (well_id, loop, channel) -> result. Later entries of a well replace earlier ones.
+# Wells whose latest entry is an error are left out, so that they are analysed again.
+def read_journal(outdir, settings_id):
+    journal_path = Path(outdir) / RESULTS_JOURNAL
+    if not journal_path.is_file():
+        return {}
 
-    if video_frames:
-        return True
-    else:
-        return False
+    software_version = config['DEFAULT']['VERSION']
+    journal = {}
+    for entry, _ in read_journal_entries(journal_path):
+        if entry.pop('config_hash', None) != settings_id or entry.get('version') != software_version:
+            continue
+
+        well = (entry['well_id'], entry['loop'], entry['channel'])
+        if entry.get('error'):
+            journal.pop(well, None)
+        else:
+            journal[well] = entry
+
+    return journal
 
 # Results:
 # Pandas df
 #   columns: {'channel', 'loop', 'well_id', 'bpm', 'fps', ...qc_attributes}
-def write_to_spreadsheet(outdir, results, experiment_id):
+# overwrite: Replace an existing results file (atomically) instead of writing a new file version.
+#            Used for consolidated results, which are refreshed while the analysis is running.
+def write_to_spreadsheet(outdir, results, experiment_id, overwrite=False):
     LOGGER.info("Saving acquired data to spreadsheet")
     software_version = config['DEFAULT']['VERSION']
     outfile_name = f"results_{experiment_id}_{software_version}.csv"
     outpath = outdir / outfile_name
 
-    # Don't erase previous results by accident
-    if outpath.is_file():
-        LOGGER.warning("Outdir already contains results file. Writing new file version")
-
-    version = 2
-    while outpath.is_file():
-        outpath = outdir / f"results_{experiment_id}_{software_version}_{version}.csv"
-        version += 1
+    if overwrite:
+        # Written to a temporary file first, so readers never see a partial file
+        tmp_path = outdir / f"{outfile_name}.{os.getpid()}.tmp"
+        outfile = open(tmp_path, 'w', newline='')
+    else:
+        # Don't erase previous results by accident
+        if outpath.is_file():
+            LOGGER.warning("Outdir already contains results file. Writing new file version")
+
+        # Reserve the file name with an exclusive create, parallel processes may write to the same outdir
+        version = 2
+        while True:
+            try:
+                outfile = open(outpath, 'x', newline='')
+                break
+            except FileExistsError:
+                outpath = outdir / f"results_{experiment_id}_{software_version}_{version}.csv"
+                version += 1
 
     #header = ['Index', 'WellID', 'Well Name', 'Loop', 'Channel', 'Heartrate (BPM)', 'fps', 'version']
     results = results.rename(columns={  'well_id'   : 'WellID', 
@@ -218,12 +687,28 @@ def write_to_spreadsheet(outdir, results, experiment_id):
 
     results.index += 1
 
-    results.to_csv(outpath, index=True, index_label='Index', na_rep='NA')
+    with outfile:
+        results.to_csv(outfile, index=True, index_label='Index', na_rep='NA')
 
+    if overwrite:
+        os.replace(tmp_path, outpath)
+
+# Output format is set in the config:
+#   frames  - one TIFF per frame, named as the original frames.
+#   stack   - one multi-page TIFF per well/loop/channel, optionally compressed.
+#             Original frame names, SL indices and timestamps are stored in the tags (see stack_frame_metadata).
 def save_cropped(cut_images, args, images_path):
     outpath = args.outdir / 'croppedRAWTiff/'
     outpath.mkdir(parents=True, exist_ok=True)
 
+    # get first image for saving as image offset
+    outfile_path = args.outdir / "offset_verifying.png"
+    cv2.imwrite(outfile_path, cut_images[0])
+
+    if config['CROPPING']['OUTPUT_FORMAT'] == 'stack':
+        save_cropped_stack(cut_images, outpath, images_path)
+        return
+
     for index, img in enumerate(cut_images):
         final_part_path = pathlib.PurePath(images_path[index]).name
         outfile_path = outpath / final_part_path
@@ -231,20 +716,78 @@ def save_cropped(cut_images, args, images_path):
         # write the image
         cv2.imwrite(outfile_path, img)
 
-        # get first image for saving as image offset
-        if index == 0:  # avoid plot more than the first frame
-            outfile_path = args.outdir / "offset_verifying.png"
-            cv2.imwrite(outfile_path, img)
-
         # create a dictionary for the first cut image id it does not exist. If it exist, just append the cut image to the specific loop/channel.
         # it is necessary because we want to replot after each well, that is, to be able to skip the crop script but have the partial results plotted
 
+def save_cropped_stack(cut_images, outpath, images_path):
+    images_path = [Path(path) for path in images_path]
+    first_frame_name = images_path[0].name
+    stack_name = re.sub(r'-SL\d+', STACK_MARKER, first_frame_name, count=1)
+    if stack_name == first_frame_name:
+        stack_name = Path(first_frame_name).stem + STACK_MARKER + '.tif'
+
+    compression = config['CROPPING']['STACK_COMPRESSION']
+    if compression == 'none':
+        compression = None
+    elif compression == 'deflate':
+        compression = 'zlib'
+    elif compression == 'zstd':
+        try:
+            import imagecodecs # tifffile needs imagecodecs for zstd
+        except ImportError:
+            LOGGER.warning("zstd compression requires the imagecodecs package. Using deflate instead")
+            compression = 'zlib'
+
+    metadata = {'names'     : [path.name for path in images_path],
+                'frames'    : [frameIdx(path.name) for path in images_path],
+                'timestamps': extract_timestamps(images_path)}
+
+    tifffile.imwrite(outpath / stack_name, np.asarray(cut_images), compression=compression, metadata=metadata)
+
+# Virtual cropping: instead of writing cropped frames, only the embryo bounding box of each well is stored.
+# The heart rate analysis then only loads this region of the raw frames.
+def save_crop_coordinates(outdir, video_metadata, region):
+    outpath = Path(outdir) / CROP_COORDINATES_DIR
+    outpath.mkdir(parents=True, exist_ok=True)
+
+    (y_start, y_stop), (x_start, x_stop) = region
+    coordinates = { 'well_id'   : video_metadata['well_id'],
+                    'loop'      : video_metadata['loop'],
+                    'channel'   : video_metadata['channel'],
+                    'y'         : [int(y_start), int(y_stop)],
+                    'x'         : [int(x_start), int(x_stop)]}
+
+    outfile_path = outpath / f"{video_metadata['channel']}-{video_metadata['loop']}-{video_metadata['well_id']}.json"
+    with open(outfile_path, 'w') as f:
+        json.dump(coordinates, f)
+
+# Returns the region stored by save_crop_coordinates() or None, if the well was not cropped.
+def load_crop_coordinates(outdir, video_metadata):
+    coordinates_path = Path(outdir) / CROP_COORDINATES_DIR / f"{video_metadata['channel']}-{video_metadata['loop']}-{video_metadata['well_id']}.json"
+    try:
+        with open(coordinates_path) as f:
+            coordinates = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    return coordinates['y'], coordinates['x']
 
 def save_panel(resulting_dict_from_crop, args):
+    renderer = config['IO']['RENDERER']
+    if renderer == 'opencv':
+        # Imported here, io_operations is also imported from within src (cluster_consolidate.py)
+        import src.render as render
+    else:
+        from matplotlib import pyplot as plt
 
     # function used to create ans save the panel with cropped images
     for item in resulting_dict_from_crop.items():
         if "positions_" not in item[0]:
+            if renderer == 'opencv':
+                render.save_panel(item[1], resulting_dict_from_crop['positions_' + item[0]],
+                                  'General view of every cropped well in ' + item[0], args.outdir / f"{item[0]}_panel.png")
+                continue
+
             axes = []  # will be used to plot the first image for each well bellow
             rows = 8
             cols = 12
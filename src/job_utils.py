@@ -1,9 +1,22 @@
+import logging
 import os
 import sys
 import subprocess
 
+import cv2
+from threadpoolctl import threadpool_limits
+
+LOGGER = logging.getLogger(__name__)
+
 MAIN_DIRECTORY = os.path.dirname(os.path.abspath(__file__)).replace('src', '')
 
+# Threads each process started by run_processes() may use. Passed on in the environment.
+THREAD_BUDGET_VARIABLE = 'MEDAKA_THREADS'
+
+# Thread pools of BLAS/OpenMP, numexpr and OpenCV, sized when the libraries are loaded
+THREAD_LIMIT_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                          'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS', 'OPENCV_FOR_THREADS_NUM')
+
 def prepare_python_cmd(args, script_name):
     # processes to be dispatched
     arguments_variable = [
@@ -20,16 +33,64 @@ def prepare_python_cmd(args, script_name):
     
     return python_cmd
 
+# Cores this process may run on
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+# Divides cores (default: all available cores) evenly across nr_processes running at the same time
+def thread_budget(nr_processes, cores=0):
+    cores = cores or available_cores()
+    return max(1, cores // max(1, nr_processes))
+
+# Environment of a child process limited to threads threads
+def thread_budget_env(threads):
+    env = dict(os.environ)
+    env[THREAD_BUDGET_VARIABLE] = str(threads)
+    for variable in THREAD_LIMIT_VARIABLES:
+        env[variable] = str(threads)
+    return env
+
+# Threads this process may use, as given by run_processes(). None if it was started without a budget.
+def process_thread_budget():
+    threads = int(os.environ.get(THREAD_BUDGET_VARIABLE, 0))
+    return threads if threads > 0 else None
+
+# Applies the thread budget given by run_processes() to OpenCV and the BLAS/OpenMP libraries of this process.
+# The frame loading threads (LOAD_THREADS) and the artifact workers (ARTIFACT_WORKERS) are capped to the budget
+# where they are started. numpy's FFT runs single threaded and needs no limit.
+# Not covered: while a well is analysed, the prefetch thread (PREFETCH_WELLS) loads the next video with its own
+# loading threads, so loading and analysis together can briefly use up to twice the budget.
+# Returns the budget or None, if the process was not started with one.
+def limit_threads():
+    threads = process_thread_budget()
+    if threads is None:
+        LOGGER.debug("No thread budget set, libraries use all cores")
+        return None
+
+    cv2.setNumThreads(threads)
+    threadpool_limits(limits=threads)
+    LOGGER.info("Thread budget: " + str(threads) + " threads for OpenCV, BLAS/OpenMP and frame loading")
+    return threads
+
 #FIXME: Tochange for a multiprocess?
-def run_processes(cmd_list, max_subprocesses=5, log=sys.stdout):
+# cores: Cores shared by the processes, default all available cores
+def run_processes(cmd_list, max_subprocesses=5, log=sys.stdout, cores=0):
     procs_list = []
     print("Processing " + str(max_subprocesses) + " subprocess at a time.", file=log)
+
+    # Avoids oversubscription: every library would otherwise start one thread per core in each process
+    threads = thread_budget(min(max_subprocesses, len(cmd_list)), cores)
+    env = thread_budget_env(threads)
+    print("Thread budget: " + str(threads) + " threads per process, " + str(cores or available_cores()) + " cores", file=log)
+
     i = max_subprocesses
     for cmd in cmd_list:
         try:
             # f = open('/home/fannoux/Work/FEHATs/test_video_medaka_bpm_out_v1.5/blou.txt', 'w') 
             # p = subprocess.Popen(cmd, stdout=f, stderr=f)
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
         
             procs_list.append(p)
 
@@ -0,0 +1,183 @@
+############################################################################################################
+# Authors:
+#   Marcio Ferreira,    EMBL-EBI,       marcio@ebi.ac.uk                            (Current Maintainer)
+#   Sebastian Stricker, Uni Heidelberg, sebastian.stricker@stud.uni-heidelberg.de   (Current Maintainer)
+# Date: 10/2026
+# License: GNU GENERAL PUBLIC LICENSE Version 3
+###
+# Fast renderer for the quality control images (RENDERER = opencv in config.ini).
+# Images are composed directly as numpy arrays with OpenCV colormaps and text and written with cv2.imwrite,
+# without creating matplotlib figures. The matplotlib renderer stays the default for publication quality plots.
+###
+############################################################################################################
+import math
+
+import numpy as np
+import cv2
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+BLACK = (0, 0, 0)
+GREY = (160, 160, 160)
+BLUE = (255, 0, 0)
+WHITE = 255
+
+# Space around and between the images of a mosaic
+MARGIN = 10
+
+# Longer side of the images in the heart region plots and the crop panel
+QC_TILE_SIZE = 500
+PANEL_TILE_SIZE = 96
+
+# Size of the frequency heatmap, without axes and colorbar
+HEATMAP_WIDTH = 640
+HEATMAP_HEIGHT = 480
+COLORBAR_WIDTH = 20
+AXIS_TICKS = 5
+
+# Scales the values between vmin and vmax (default: minimum and maximum of image) to 0-255, as imshow does
+def to_uint8(image, vmin=None, vmax=None):
+    image = np.nan_to_num(np.asarray(image, dtype=np.float32))
+    vmin = image.min() if vmin is None else vmin
+    vmax = image.max() if vmax is None else vmax
+    if vmax <= vmin:
+        return np.zeros(image.shape, dtype=np.uint8)
+
+    scaled = (image - vmin) * (255 / (vmax - vmin))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+# 8 bit BGR image of a 2D array or a BGR image. Coloured with colormap (cv2.COLORMAP_*) or kept as is if None.
+def colorize(image, colormap=None, vmin=None, vmax=None):
+    image8 = to_uint8(image, vmin, vmax)
+    if image8.ndim == 3:
+        if colormap is None:
+            return image8
+        image8 = cv2.cvtColor(image8, cv2.COLOR_BGR2GRAY)
+
+    if colormap is None:
+        return cv2.cvtColor(image8, cv2.COLOR_GRAY2BGR)
+    return cv2.applyColorMap(image8, colormap)
+
+# Scales image so that its longer side has size pixels. Enlarged images keep sharp pixel edges.
+def fit(image, size):
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_NEAREST
+    return cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=interpolation)
+
+# Writes text with its centre at x and its baseline at y
+def put_text(canvas, text, x, y, font_scale=0.5, color=BLACK):
+    (text_width, _), _ = cv2.getTextSize(text, FONT, font_scale, 1)
+    cv2.putText(canvas, text, (int(x - text_width / 2), int(y)), FONT, font_scale, color, 1, cv2.LINE_AA)
+
+# Adds a line of text above the image, on white background
+def titled(image, title, font_scale=0.5, color=BLACK):
+    (text_width, text_height), baseline = cv2.getTextSize(title, FONT, font_scale, 1)
+    title_height = text_height + baseline + MARGIN
+    width = max(image.shape[1], text_width + 2 * MARGIN)
+
+    tile = np.full((title_height + image.shape[0], width, 3), WHITE, dtype=np.uint8)
+    x = (width - image.shape[1]) // 2
+    tile[title_height:, x:x + image.shape[1]] = image
+    put_text(tile, title, width / 2, text_height + MARGIN // 2, font_scale, color)
+
+    return tile
+
+# Arranges the images in a grid with cols columns, each image centered in its cell
+def mosaic(images, cols):
+    cell_height = max(image.shape[0] for image in images)
+    cell_width  = max(image.shape[1] for image in images)
+    rows = math.ceil(len(images) / cols)
+
+    canvas = np.full((MARGIN + rows * (cell_height + MARGIN), MARGIN + cols * (cell_width + MARGIN), 3), WHITE, dtype=np.uint8)
+    for i, image in enumerate(images):
+        row, col = divmod(i, cols)
+        y = MARGIN + row * (cell_height + MARGIN) + (cell_height - image.shape[0]) // 2
+        x = MARGIN + col * (cell_width + MARGIN) + (cell_width - image.shape[1]) // 2
+        canvas[y:y + image.shape[0], x:x + image.shape[1]] = image
+
+    return canvas
+
+def write_png(path, image):
+    if not cv2.imwrite(str(path), image):
+        raise OSError(f"Couldn't write image {path}")
+
+################################################################################ QC images
+# Image of a 2D array, as segment_heart.save_image()
+def save_image(image, name, outdir):
+    image = titled(fit(colorize(image, cv2.COLORMAP_VIRIDIS), QC_TILE_SIZE), name)
+    write_png(outdir / f"{name}.png", image)
+
+# First frame and the heart region masks in a 2x2 mosaic, as segment_heart.draw_heart_qc_plot()
+def draw_heart_qc_plot(single_frame, abs_changes, all_roi, hroi_mask, out_dir):
+    tiles = [
+        titled(fit(colorize(single_frame), QC_TILE_SIZE),                      'Embryo'),
+        titled(fit(colorize(abs_changes, cv2.COLORMAP_VIRIDIS), QC_TILE_SIZE), 'Pixels emitting change'),
+        titled(fit(colorize(hroi_mask, cv2.COLORMAP_VIRIDIS), QC_TILE_SIZE),   'Emitting clear periodic change'),
+        titled(fit(colorize(all_roi, cv2.COLORMAP_VIRIDIS), QC_TILE_SIZE),     'Largest of these regions'),
+    ]
+    write_png(out_dir / "embryo_heart_roi.png", mosaic(tiles, cols=2))
+
+# Amplitudes of every frequency (x axis) for every pixel (y axis) with axes and colorbar,
+# as the heatmap of segment_heart.plot_frequencies_2d().
+# step: Rows of amplitudes are every step-th pixel of the heart region.
+def plot_frequency_heatmap(amplitudes, bins, step, outdir):
+    amplitudes = np.asarray(amplitudes)
+    bins = np.asarray(bins)
+    vmax = amplitudes.max()
+
+    # Pixel 0 at the bottom, as in the matplotlib plot
+    heatmap = colorize(amplitudes[::-1], cv2.COLORMAP_HOT, vmin=0, vmax=vmax)
+    heatmap = cv2.resize(heatmap, (HEATMAP_WIDTH, HEATMAP_HEIGHT), interpolation=cv2.INTER_NEAREST)
+
+    gradient = np.linspace(vmax, 0, HEATMAP_HEIGHT)[:, np.newaxis].repeat(COLORBAR_WIDTH, axis=1)
+    colorbar = colorize(gradient, cv2.COLORMAP_HOT, vmin=0, vmax=vmax)
+
+    left, top, bottom, right = 70, 40, 60, 90
+    canvas = np.full((top + HEATMAP_HEIGHT + bottom, left + HEATMAP_WIDTH + right, 3), WHITE, dtype=np.uint8)
+    canvas[top:top + HEATMAP_HEIGHT, left:left + HEATMAP_WIDTH] = heatmap
+    cv2.rectangle(canvas, (left - 1, top - 1), (left + HEATMAP_WIDTH, top + HEATMAP_HEIGHT), BLACK, 1)
+
+    bar_x = left + HEATMAP_WIDTH + MARGIN
+    canvas[top:top + HEATMAP_HEIGHT, bar_x:bar_x + COLORBAR_WIDTH] = colorbar
+    cv2.rectangle(canvas, (bar_x - 1, top - 1), (bar_x + COLORBAR_WIDTH, top + HEATMAP_HEIGHT), BLACK, 1)
+    for value, y in ((vmax, top + 5), (0, top + HEATMAP_HEIGHT)):
+        cv2.putText(canvas, f"{value:.3g}", (bar_x + COLORBAR_WIDTH + 5, y), FONT, 0.4, BLACK, 1, cv2.LINE_AA)
+
+    # Frequency ticks
+    for frequency in np.linspace(bins.min(), bins.max(), AXIS_TICKS):
+        span = bins.max() - bins.min()
+        x = left + (frequency - bins.min()) / span * (HEATMAP_WIDTH - 1) if span else left
+        cv2.line(canvas, (int(x), top + HEATMAP_HEIGHT), (int(x), top + HEATMAP_HEIGHT + 5), BLACK, 1)
+        put_text(canvas, f"{frequency:.2f}", x, top + HEATMAP_HEIGHT + 20, 0.4)
+
+    # Pixel ticks
+    last_pixel = (len(amplitudes) - 1) * step
+    for pixel in np.linspace(0, last_pixel, AXIS_TICKS):
+        y = top + HEATMAP_HEIGHT - 1 - (pixel / last_pixel * (HEATMAP_HEIGHT - 1) if last_pixel else 0)
+        cv2.line(canvas, (left - 6, int(y)), (left - 1, int(y)), BLACK, 1)
+        put_text(canvas, str(int(round(pixel))), left - 30, y + 5, 0.4)
+
+    put_text(canvas, 'frequency', left + HEATMAP_WIDTH / 2, top + HEATMAP_HEIGHT + 45)
+    put_text(canvas, 'pixel', left / 2 - 10, top - 10)
+    put_text(canvas, 'Frequency intensities per pixel', left + HEATMAP_WIDTH / 2, top - 15, 0.6)
+
+    write_png(outdir / "fourier_signals_heatmap.png", canvas)
+
+################################################################################ Crop panel
+# First cropped frame of every well of the plate in an 8x12 grid, as io_operations.save_panel()
+# images, well_ids: First cropped frame and well id of each cropped well
+def save_panel(images, well_ids, title, outfile_path):
+    images_by_well = dict(zip(well_ids, images))
+
+    tiles = []
+    for well_nr in range(1, 97):
+        well_id = 'WE000' + '{:02d}'.format(well_nr)
+        if well_id in images_by_well:
+            tile = fit(colorize(images_by_well[well_id]), PANEL_TILE_SIZE)
+        else:
+            tile = np.full((PANEL_TILE_SIZE, PANEL_TILE_SIZE, 3), WHITE, dtype=np.uint8)
+        cv2.rectangle(tile, (0, 0), (tile.shape[1] - 1, tile.shape[0] - 1), GREY, 1)
+        tiles.append(titled(tile, well_id, font_scale=0.4, color=BLUE))
+
+    panel = titled(mosaic(tiles, cols=12), title, font_scale=0.8, color=BLUE)
+    write_png(outfile_path, panel)
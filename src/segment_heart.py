@@ -15,8 +15,10 @@
 #   calculating bpm frequency from pixel color fluctuation in said videos
 ###
 ############################################################################################################
+from concurrent.futures import ProcessPoolExecutor
+import itertools
 import math
-from matplotlib import pyplot as plt
+import multiprocessing
 from pathlib import Path
 import logging
 
@@ -27,11 +29,10 @@ import cv2
 from skimage.filters import threshold_triangle
 
 import scipy.stats
-import scipy.interpolate
 from scipy.signal import savgol_filter, detrend 
+from threadpoolctl import threadpool_limits
 
-import matplotlib
-matplotlib.use('Agg')
+import src.render as render
 
 # Read config
 import configparser
@@ -48,45 +49,152 @@ config.read(config_path)
 ##########################
 
 LOGGER = logging.getLogger(__name__)
-logging.getLogger("matplotlib").setLevel(logging.WARNING)
 
 # Kernel for image smoothing
 KERNEL = np.ones((5, 5), np.uint8)
 
-def save_video(video, fps, outdir, filename):
+# normVideo: pixels sampled for the percentiles
+NORM_SAMPLE_SIZE = 1000000
+
+# normVideo, assert_8bit: frames converted at a time
+CHUNK_FRAMES = 16
+
+# assert_8bit: 16 bit intensity -> 8 bit intensity
+UINT16_TO_UINT8 = np.minimum(np.arange(2**16) // 255, 255).astype(np.uint8)
+
+# detect_changes: number of frame to frame changes thresholded together
+CHANGE_CHUNK_FRAMES = 16
+
+# Quality control output of each well (ARTIFACT_LEVEL in config.ini)
+#   none    - no images or videos
+#   summary - frequency heatmap of at most SUMMARY_HEATMAP_PIXELS pixels
+#   full    - videos, heart region plots and frequency plots of all pixels
+ARTIFACT_LEVELS = ('none', 'summary', 'full')
+SUMMARY_HEATMAP_PIXELS = 500
+
+# Background processes rendering the quality control plots, see start_artifact_renderer()
+ARTIFACT_POOL = None
+ARTIFACT_JOBS = []
+
+def single_threaded():
     """
-        Main Algorithm
-        Heart Segmentation and frequeny detection
+        Limits OpenCV and BLAS/OpenMP of an artifact worker process to one thread each
     """
-    video = assert_8bit(video)
-    
-    if(len(video[0].shape) == 2):
-        video = np.array([cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB) for frame in video])
+    cv2.setNumThreads(1)
+    threadpool_limits(limits=1)
 
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+def start_artifact_renderer(workers):
+    """
+        Renders the quality control plots of run() in worker processes from now on, so that run() returns
+        as soon as the bpm is known. With 0 workers, plots are rendered in run().
+        Each worker renders with a single thread.
+    """
+    global ARTIFACT_POOL
+    if workers > 0 and ARTIFACT_POOL is None:
+        ARTIFACT_POOL = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=single_threaded)
 
-    try:
-        height, width, layers = video[0].shape
-    except (IndexError, ValueError):
-        height, width = video[0].shape
-    size = (width, height)
+def render_artifact(function, *args, **kwargs):
+    """
+        Calls the plotting function in a worker process if the renderer was started, otherwise right away
+    """
+    if ARTIFACT_POOL is None:
+        function(*args, **kwargs)
+    else:
+        ARTIFACT_JOBS.append(ARTIFACT_POOL.submit(function, *args, **kwargs))
+
+def wait_artifacts():
+    """
+        Waits until all submitted plots are written. Failed plots are logged.
+    """
+    while ARTIFACT_JOBS:
+        try:
+            ARTIFACT_JOBS.pop(0).result()
+        except Exception:
+            LOGGER.exception("Couldn't render quality control plot")
+
+def stop_artifact_renderer():
+    """
+        Waits for all submitted plots and shuts the worker processes down
+    """
+    global ARTIFACT_POOL
+    wait_artifacts()
+    if ARTIFACT_POOL is not None:
+        ARTIFACT_POOL.shutdown()
+        ARTIFACT_POOL = None
+
+def pyplot():
+    """
+        Imports pyplot on first use, so that processes rendering with OpenCV (RENDERER in config.ini) don't load matplotlib
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    logging.getLogger("matplotlib").setLevel(logging.WARNING)
+
+    from matplotlib import pyplot as plt
+    return plt
+
+def save_video(video, fps, outdir, filename):
+    """
+        Writes the frames of video (array or generator of frames) one at a time into an mp4 video
+    """
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
     out_vid = outdir / filename
-    out = cv2.VideoWriter(out_vid, fourcc, fps, size)
+    out = None
+
+    for frame in video:
+        frame = assert_8bit(frame)
+
+        if(len(frame.shape) == 2):
+            frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
 
-    for i in range(len(video)):
-        out.write(video[i])
-    out.release()
+        if out is None:
+            height, width = frame.shape[:2]
+            size = (width, height)
+            out = cv2.VideoWriter(out_vid, fourcc, fps, size)
 
-def normVideo(frames):
+        out.write(frame)
+
+    if out is not None:
+        out.release()
+
+def normalization_lut(min_value, max_value, dtype):
     """
-        Normalise across frames to harmonise intensities
-        TODO: A single outlier will worsen the normalization. Ignore extreme outliers for the stretching.
+        Normalised value of every possible intensity of dtype (8 or 16 bit), stretching min_value..max_value to the full range
     """
-    min_in_frames = np.min(frames)
-    max_in_frames = np.max(frames)
+    dtype_max = np.iinfo(dtype).max
+    lut = (np.arange(dtype_max + 1) - min_value) / (max_value-min_value) * dtype_max
+    lut = np.clip(lut, 0, dtype_max).astype(dtype)
+
+    return lut
+
+def normVideo(frames, in_place=False):
+    """
+        Normalise across frames to harmonise intensities
+        Stretches intensities between the min and max of the video, or between the robust percentiles set by
+        NORM_PERCENTILE in config.ini, so that a few outlier pixels do not ruin the stretch.
+        8 and 16 bit videos are normalised with a lookup table, in_place overwrites frames instead of a copy.
+    """
+    percentile = config['ANALYSIS'].getfloat('NORM_PERCENTILE')
+    if percentile > 0:
+        # Percentiles of a subsample of at most NORM_SAMPLE_SIZE pixels
+        sample = frames.reshape(-1)[::max(1, frames.size // NORM_SAMPLE_SIZE)]
+        min_in_frames, max_in_frames = np.percentile(sample, [percentile, 100 - percentile])
+    else:
+        min_in_frames = np.min(frames)
+        max_in_frames = np.max(frames)
+
+    if frames.dtype not in (np.uint8, np.uint16):
+        norm_frames = (np.subtract(frames, min_in_frames) / (max_in_frames-min_in_frames)) * np.iinfo(frames.dtype).max
+        norm_frames = np.clip(norm_frames, 0, np.iinfo(frames.dtype).max).astype(frames.dtype)
+        return norm_frames
+
+    lut = normalization_lut(min_in_frames, max_in_frames, frames.dtype)
 
-    norm_frames = (np.subtract(frames, min_in_frames) / (max_in_frames-min_in_frames)) * np.iinfo(frames.dtype).max
-    norm_frames = norm_frames.astype(frames.dtype)
+    norm_frames = frames if in_place else np.empty_like(frames)
+    for chunk_start in range(0, len(frames), CHUNK_FRAMES):
+        chunk = slice(chunk_start, chunk_start + CHUNK_FRAMES)
+        norm_frames[chunk] = lut[frames[chunk]]
 
     return norm_frames
 
@@ -103,32 +211,47 @@ def PixelSignal(hroi_pixels):
     return(pixel_signals)
 
 
-def plot_frequencies_2d(amplitudes, bins, outdir):
+def plot_frequencies_2d(amplitudes, bins, outdir, surface=True, max_pixels=None):
     """
         Plots amplitudes for each frequency on x axis, pixels on y axis.
         2D plot of frequencies detected in the region.
+        surface: Also plot the amplitudes as 3D surface.
+        max_pixels: Plot only every n-th pixel, so that at most max_pixels are shown.
     """
     # Ensures parameters are numpy arrays - meshgrid function works
     amplitudes = np.array(amplitudes)
     bins = np.array(bins)
 
-    # 3D Plot
-    fig = plt.figure()
-    ax = fig.add_subplot(111, projection='3d')
+    step = 1
+    if max_pixels:
+        step = max(1, math.ceil(len(amplitudes) / max_pixels))
+    amplitudes = amplitudes[::step]
+
+    # Heatmap only, the 3D surface needs matplotlib
+    if config['IO']['RENDERER'] == 'opencv':
+        render.plot_frequency_heatmap(amplitudes, bins, step, outdir)
+        return
+
+    plt = pyplot()
 
     x = bins
-    y = range(len(amplitudes))
+    y = range(0, len(amplitudes) * step, step)
     X, Y = np.meshgrid(x, y)
 
-    ax.plot_surface(X, Y, amplitudes)
-    ax.set_xlabel('frequency')
-    ax.set_ylabel('pixel')
-    ax.set_zlabel('frequency amplitude')
+    # 3D Plot
+    if surface:
+        fig = plt.figure()
+        ax = fig.add_subplot(111, projection='3d')
 
-    out_fig = outdir / "fourier_signals_3D.png"
-    plt.savefig(out_fig, bbox_inches='tight')
+        ax.plot_surface(X, Y, amplitudes)
+        ax.set_xlabel('frequency')
+        ax.set_ylabel('pixel')
+        ax.set_zlabel('frequency amplitude')
 
-    plt.close()
+        out_fig = outdir / "fourier_signals_3D.png"
+        plt.savefig(out_fig, bbox_inches='tight')
+
+        plt.close()
 
     # 2D heatmap (adapted from Erasmus Cedernaes, stackoverflow)
     fig, ax = plt.subplots()
@@ -154,6 +277,10 @@ def fourier_transform(hroi_pixels, times):
     # Rotates array. Instead of frames, the first dimension are the pixels.
     pixel_signals = PixelSignal(hroi_pixels)
 
+    # The filters and the FFT keep the precision of the signals (float32 -> complex64). See PRECISION in config.ini
+    if config['ANALYSIS']['PRECISION'] == 'float32':
+        pixel_signals = pixel_signals.astype(np.float32)
+
     # Get Discrete Fourier frequencies. Defined by sample length
     N = pixel_signals[0].size
     timestep = np.mean(np.diff(times))
@@ -177,8 +304,8 @@ def analyse_frequencies(amplitudes, freqs):
     bpm = None
 
     # Get top frequency in each pixel
-    max_indices = [np.argmax(pixel_freqs) for pixel_freqs in amplitudes]
-    highest_freqs = [freqs[idx] for idx in max_indices]
+    max_indices = np.argmax(amplitudes, axis=1)
+    highest_freqs = freqs[max_indices]
     
     # Take frequency that is most often the max
     max_freq = scipy.stats.mode(highest_freqs).mode
@@ -190,6 +317,23 @@ def analyse_frequencies(amplitudes, freqs):
 
     return bpm, qc_data
 
+def sequential_sum(values, axis=-1):
+    """
+        Sum along axis, adding up the values one after another like Python's sum().
+        np.sum uses pairwise summation, which can differ in the last digits.
+    """
+    if values.shape[axis] == 0:
+        return np.sum(values, axis=axis)
+    return np.take(np.cumsum(values, axis=axis), -1, axis=axis)
+
+def top_5percent(values):
+    """
+        Highest 5% (at least one) of values, in ascending order.
+    """
+    n_5percent = math.ceil(len(values)/20)
+    top_values = np.partition(values, len(values) - n_5percent)[-n_5percent:]
+    return np.sort(top_values)
+
 def frequency_qc_attributes(max_freq, freqs, amplitudes, max_indices, highest_freqs):
     """
         Get qc attributes out of the frequency spectrum data
@@ -199,26 +343,18 @@ def frequency_qc_attributes(max_freq, freqs, amplitudes, max_indices, highest_fr
     ### INTENSITY OF HARMONICS
     # Find upper and lower harmonic
     freq_step = freqs[1] - freqs[0]
-    lower_harmonic = freqs[np.where(np.abs(freqs-(max_freq/2)) < (freq_step/1.5))]
-    upper_harmonic = freqs[np.where(np.abs(freqs-(max_freq*2)) < (freq_step/1.5))]
+    lower_harmonic = np.abs(freqs-(max_freq/2)) < (freq_step/1.5)
+    upper_harmonic = np.abs(freqs-(max_freq*2)) < (freq_step/1.5)
 
     # Ensures harmonics outside of potential spectrum are not considered
-    candidate_freqs = np.concatenate((lower_harmonic, upper_harmonic))
-    candidate_idcs  = [np.where(freqs == freq) for freq in candidate_freqs]
+    candidate_idcs = np.concatenate((np.flatnonzero(lower_harmonic), np.flatnonzero(upper_harmonic)))
 
     # Find highest top 5% intesity of harmonic. (higher or lower)
     harmonic_intensity = 0
     for freq_idx in candidate_idcs:
 
-        # Get amplitudes of harmonic
-        freq_amplitudes = [pixel_freqs[freq_idx] for pixel_freqs in amplitudes]
-        freq_amplitudes.sort()
-
-        # limit to top 5% of values
-        n_5percent = math.ceil(len(freq_amplitudes)/20)
-        freq_amplitudes = freq_amplitudes[-n_5percent:]
-
-        i = np.average(freq_amplitudes)
+        # Average of the top 5% amplitudes of the harmonic
+        i = np.average(top_5percent(amplitudes[:, freq_idx]))
 
         if i > harmonic_intensity:
             harmonic_intensity = i
@@ -227,21 +363,18 @@ def frequency_qc_attributes(max_freq, freqs, amplitudes, max_indices, highest_fr
 
     ### SIGNAL TO NOISE RATIO & INTENSITY#
     # Get SNR of pixels which contained max_freq
-    SNR         = [(pixel_freqs[idx]/sum(pixel_freqs))  for pixel_freqs, idx in zip(amplitudes, max_indices) if freqs[idx] == max_freq]
-    intensity   = [(pixel_freqs[idx])                   for pixel_freqs, idx in zip(amplitudes, max_indices) if freqs[idx] == max_freq]
-
-    overall_snr = sum(SNR)/len(SNR)
-    overall_i   = sum(intensity)/len(intensity)
+    max_freq_pixels = highest_freqs == max_freq
+    intensity   = amplitudes[max_freq_pixels, max_indices[max_freq_pixels]]
+    SNR         = intensity / sequential_sum(amplitudes[max_freq_pixels], axis=1)
 
-    n_5percent = math.ceil(len(SNR)/20)
+    overall_snr = sequential_sum(SNR)/len(SNR)
+    overall_i   = sequential_sum(intensity)/len(intensity)
 
     # top contributers SNR
-    SNR.sort()
-    top_snr = np.average(SNR[-n_5percent:])
+    top_snr = np.average(top_5percent(SNR))
 
     # top contributers Signal Intensities
-    intensity.sort()
-    top_i = np.average(intensity[-n_5percent:])
+    top_i = np.average(top_5percent(intensity))
     
     qc_data['SNR']              = overall_snr
     qc_data['Signal intensity'] = round(overall_i)
@@ -274,10 +407,15 @@ def frequency_qc_attributes(max_freq, freqs, amplitudes, max_indices, highest_fr
     
     return qc_data
 
-def bpm_from_heartregion(hroi_pixels, times, out_dir):
+# interpolate: times are the frame timestamps, the pixel signals are interpolated to equally spaced timestamps first
+# artifact_level: Plots of the frequency spectrum (see ARTIFACT_LEVEL in config.ini)
+def bpm_from_heartregion(hroi_pixels, times, out_dir, interpolate=False, artifact_level='full'):
     minBPM = config['ANALYSIS'].getint('MIN_BPM')
     maxBPM = config['ANALYSIS'].getint('MAX_BPM')
 
+    if interpolate:
+        hroi_pixels, times = interpolate_timestamps(hroi_pixels, times)
+
     # Get Frequency Spectrum for each pixel.
     amplitudes, freqs = fourier_transform(hroi_pixels, times)
 
@@ -285,10 +423,13 @@ def bpm_from_heartregion(hroi_pixels, times, out_dir):
     heart_freqs_indices = np.where(np.logical_and(freqs >= (minBPM/60), freqs <= (maxBPM/60)))[0]
     
     freqs       = freqs[heart_freqs_indices]
-    amplitudes  = np.array([pixel_freqs[heart_freqs_indices] for pixel_freqs in amplitudes])
+    amplitudes  = amplitudes[:, heart_freqs_indices]
 
     # Plot pixel amplitudes for manual quality control
-    plot_frequencies_2d(amplitudes, freqs, out_dir)
+    if artifact_level == 'full':
+        render_artifact(plot_frequencies_2d, amplitudes, freqs, out_dir)
+    elif artifact_level == 'summary':
+        render_artifact(plot_frequencies_2d, amplitudes, freqs, out_dir, surface=False, max_pixels=SUMMARY_HEATMAP_PIXELS)
 
     # Attempt to find bpm
     bpm, qc_data = analyse_frequencies(amplitudes, freqs)
@@ -342,65 +483,149 @@ def equally_spaced_timestamps(nr_of_frames, fps):
 
     return equal_space_times
 
-def interpolate_timestamps(video, timestamps):
+def hermite_slope(pixels, times, k):
     """
-        timestamp spacing can vary by a few ms. Provides interpolated timestamps
+        Slope of the pixel signals at sample k. Central difference, one sided at the first and last sample.
+    """
+    before  = max(k - 1, 0)
+    after   = min(k + 1, len(times) - 1)
+
+    return (pixels[after].astype(np.float64) - pixels[before]) / (times[after] - times[before])
+
+def interpolate_timestamps(pixels, timestamps):
+    """
+        timestamp spacing can vary by a few ms. Resamples pixel signals (frames x pixels) to equally spaced timestamps.
+        Local cubic (Catmull-Rom) interpolation, computed one output frame at a time from the 4 neighbouring frames.
+        Returns the interpolated pixels and the timestamps in seconds.
     """
     LOGGER.info("Interpolating timestamps")
+    times = np.asarray(timestamps, dtype=np.float64)
 
     # Calculate equaly spaced sample points
-    equal_space_times = np.linspace(start=timestamps[0], stop=timestamps[-1], num=len(video), endpoint=True)
-    
-    # Interpolate pixel values of the video
-    # Quite ressource intensive for full resolution images. (~16GB for 130*2048*2048).
-    # Splitting into 10 subparts to mitigate this.
-    interpolated_video = []
-    for sub_arr in np.array_split(video, 10, axis=1):
+    equal_space_times = np.linspace(start=times[0], stop=times[-1], num=len(times), endpoint=True)
+
+    # Interval [times[k], times[k+1]] of each sample point
+    intervals = np.clip(np.searchsorted(times, equal_space_times, side='right') - 1, 0, len(times) - 2)
 
-        interpolated_arr = scipy.interpolate.interp1d(timestamps, sub_arr, axis=0, kind="cubic")(equal_space_times)
-        interpolated_arr = np.clip(interpolated_arr, 0, np.iinfo(video.dtype).max)
-        interpolated_arr = np.asarray(interpolated_arr, dtype=video.dtype)
+    max_value = np.iinfo(pixels.dtype).max
+    interpolated_pixels = np.empty_like(pixels)
+    for i, (t, k) in enumerate(zip(equal_space_times, intervals)):
+        h = times[k+1] - times[k]
+        s = (t - times[k]) / h
 
-        interpolated_video.append(interpolated_arr)
+        # Cubic hermite basis
+        h00 = 2*s**3 - 3*s**2 + 1
+        h10 = s**3 - 2*s**2 + s
+        h01 = -2*s**3 + 3*s**2
+        h11 = s**3 - s**2
 
-    interpolated_video = np.concatenate(interpolated_video, axis=1)
+        values = (h00 * pixels[k] + h10 * h * hermite_slope(pixels, times, k)
+                + h01 * pixels[k+1] + h11 * h * hermite_slope(pixels, times, k+1))
+        interpolated_pixels[i] = np.clip(values, 0, max_value)
 
-    return interpolated_video, equal_space_times
+    return interpolated_pixels, timestamps_in_seconds(equal_space_times)
 
 def timestamps_in_seconds(timestamps):
     timestamps = np.asarray((timestamps - timestamps[0]) / 1000, dtype=np.float16)
     
     return timestamps
 
-def absdiff_between_frames(video):
+def frame2frame_differences(video):
     """
-        Frame to frame absolute difference
+        Frame to frame absolute difference, generated one pair of frames at a time
     """
-    # Last frame has no differencs
-    frame2frame_changes = np.zeros_like(video[:-1])
-
     # Blur smooths noise -> focus on larger regional changes
-    blurred_video = np.array([cv2.GaussianBlur(frame, (9, 9), 0) for frame in video])
+    previous_blurred = cv2.GaussianBlur(video[0], (9, 9), 0)
+    for frame in video[1:]:
+        blurred = cv2.GaussianBlur(frame, (9, 9), 0)
+        yield cv2.absdiff(previous_blurred, blurred)
+        previous_blurred = blurred
 
-    frame2frame_changes = np.array([cv2.absdiff(frame, blurred_video[i+1]) for i, frame in enumerate(blurred_video[:-1])])
+def threshold_triangle_frames(frames):
+    """
+        Triangle threshold of each frame of an 8 bit video. Same result as skimage's threshold_triangle per frame,
+        but computed from the histograms of all frames at once.
+    """
+    nr_frames = len(frames)
+    levels = np.arange(256)
+
+    # Histogram of each frame. calcHist counts in float32, exact up to 2**24 pixels per frame.
+    if frames[0].size < 2**24:
+        hists = np.array([cv2.calcHist([frame], [0], None, [256], [0, 256])[:, 0] for frame in frames], dtype=np.int64)
+    else:
+        hists = np.array([np.bincount(frame.reshape(-1), minlength=256) for frame in frames], dtype=np.int64)
+
+    # Find peak, lowest and highest gray levels. skimage's histogram covers only the levels low to high.
+    occupied        = hists > 0
+    low             = np.argmax(occupied, axis=1)
+    high            = 255 - np.argmax(occupied[:, ::-1], axis=1)
+    nbins           = high - low + 1
+    arg_peak_height = np.argmax(hists, axis=1) - low
+    peak_height     = hists[np.arange(nr_frames), arg_peak_height + low]
+
+    # Flip is True if left tail is shorter.
+    flip = arg_peak_height < nbins - 1 - arg_peak_height
+    arg_peak_height = np.where(flip, nbins - arg_peak_height - 1, arg_peak_height)
+
+    # Set up the coordinate system. Histogram values y1 from the lowest level, or from the highest if flipped.
+    width   = arg_peak_height
+    x1      = levels[np.newaxis, :]
+    y1      = np.take_along_axis(hists, np.clip(np.where(flip[:, np.newaxis], high[:, np.newaxis] - x1, low[:, np.newaxis] + x1), 0, 255), axis=1)
 
-    return frame2frame_changes
+    # Normalize.
+    norm = np.sqrt(peak_height**2 + width**2)
+
+    # Maximize the length, only up to the peak of each frame.
+    length = (peak_height / norm)[:, np.newaxis] * x1 - (width / norm)[:, np.newaxis] * y1
+    length[x1 >= width[:, np.newaxis]] = -np.inf
+    arg_level = np.argmax(length, axis=1)
+    arg_level = np.where(flip, nbins - arg_level - 1, arg_level)
+
+    # Frames with constant intensity
+    return np.where(low == high, low, low + arg_level)
 
 def threshold_changes(frame2frame_difference, min_area=300):
     """
         Filter away pixels that change not much
     """
     # Only pixels with the most changes
-    thresholded_differences = np.array([diff > threshold_triangle(diff) for diff in frame2frame_difference], dtype=np.uint8)
+    if frame2frame_difference.dtype == np.uint8:
+        thresholds = threshold_triangle_frames(frame2frame_difference)
+    else:
+        thresholds = np.array([threshold_triangle(diff) for diff in frame2frame_difference])
+    thresholded_differences = np.asarray(frame2frame_difference > thresholds[:, np.newaxis, np.newaxis], dtype=np.uint8)
 
     # Opening to remove noise
     thresholded_differences = np.array([cv2.morphologyEx(diff, cv2.MORPH_OPEN, KERNEL) for diff in thresholded_differences])
 
     return thresholded_differences
 
-def detect_movement(frame2frame_changes):
+def detect_changes(video):
+    """
+        Frame to frame changes in a single pass over the video, keeping only a few frames at a time.
+        Frames are blurred and differenced (see frame2frame_differences), then thresholded in chunks (see threshold_changes).
+        Returns the number of changed pixels for each pair, the mask of pixels that changed in any pair
+        and the sum of the absolute differences over all pairs.
+    """
+    change_sums     = []
+    changed         = np.zeros(video.shape[1:], dtype=bool)
+    difference_sum  = np.zeros(video.shape[1:], dtype=np.uint64)
+
+    frame_differences = frame2frame_differences(video)
+    for chunk_start in range(1, len(video), CHANGE_CHUNK_FRAMES):
+        differences = np.array(list(itertools.islice(frame_differences, CHANGE_CHUNK_FRAMES)))
+
+        for difference, thresholded in zip(differences, threshold_changes(differences)):
+            change_sums.append(np.sum(thresholded))
+            changed |= thresholded.astype(bool)
+            difference_sum += difference
+
+    return change_sums, changed, difference_sum
+
+def detect_movement(change_sums):
     """
         Detects movement based on absolute frame change threshold. Threshold found empirically.
+        change_sums: number of changed pixels of each frame to frame change (see detect_changes)
         Returns start and stop frame with maximal uninterrupted video length
         
         warning: return value of 'stop_frame' is a slice index. When used as array index may yield out of bounds error.
@@ -408,8 +633,7 @@ def detect_movement(frame2frame_changes):
     max_change = 0
     movement_frames = []
 
-    for i, frame in enumerate(frame2frame_changes):
-        change = np.sum(frame)
+    for i, change in enumerate(change_sums):
         if change > max_change:
             max_change = change
             
@@ -420,7 +644,7 @@ def detect_movement(frame2frame_changes):
     if movement_frames:
         # add first and last frame to tart/stop frame candidates
         movement_frames.insert(0,0)
-        movement_frames.append(len(frame2frame_changes))
+        movement_frames.append(len(change_sums))
         max_length = 0
 
         for i in range(len(movement_frames)-1):
@@ -431,7 +655,7 @@ def detect_movement(frame2frame_changes):
                 max_length = length
     else:
         start_frame = 0
-        stop_frame = len(frame2frame_changes)
+        stop_frame = len(change_sums)
     
     return start_frame, stop_frame, max_change
 
@@ -464,38 +688,38 @@ def hroi_from_blobs(regions_of_interest, min_area=300):
 
     return hroi_mask
 
-def HROI(video, frame2frame_changes, timestamps):
+def HROI(video, changed, timestamps, interpolate=False):
     """
         hroi... heart region of interest
-        Analyse frame2frame changes for heart region (also returns candidate pixels from intermediate steps)
+        Analyse pixels that changed from frame to frame (mask, see detect_changes) for heart region
+        (also returns candidate pixels from intermediate steps)
+        interpolate: timestamps are the frame timestamps, the candidate pixel signals are interpolated to equally spaced timestamps
     """
 
     minBPM = config['ANALYSIS'].getint('MIN_BPM')
     maxBPM = config['ANALYSIS'].getint('MAX_BPM')
 
-    # Create mask of all pixels that exhibited change
-    change_mask = np.zeros_like(video[0])
-    for frame in frame2frame_changes:
-        change_mask = cv2.bitwise_or(frame, change_mask)
+    # Mask of all pixels that exhibited change
+    change_mask = changed.astype(video.dtype)
 
     # save indices(x,y coords) to later filter by snr
-    indices = np.where(change_mask)
+    indices = np.where(changed)
 
     # Extract changing pixels
     # change_pixels.shape = (nr_frames, nr_change_pixels)
-    change_pixels = np.array([frame[indices] for frame in video])
+    change_pixels = video[:, changed]
+
+    if interpolate:
+        change_pixels, timestamps = interpolate_timestamps(change_pixels, timestamps)
 
     pixel_amplitudes, freqs = fourier_transform(change_pixels, timestamps)
 
     # Limit to frequencies within defined borders
     heart_freqs_indices = np.where(np.logical_and(freqs >= (minBPM/60), freqs <= (maxBPM/60)))[0]
-    pixel_amplitudes  = np.array([pixel_freqs[heart_freqs_indices] for pixel_freqs in pixel_amplitudes])
+    pixel_amplitudes  = pixel_amplitudes[:, heart_freqs_indices]
     
     # Get SNR
-    max_indices = [np.argmax(pix_amps)      for pix_amps in pixel_amplitudes]
-
-    SNR = [(pix_amps[idx]/sum(pix_amps))    for pix_amps, idx in zip(pixel_amplitudes, max_indices)]
-    SNR = np.array(SNR)
+    SNR = np.max(pixel_amplitudes, axis=1) / sequential_sum(pixel_amplitudes, axis=1)
 
     # intensity = [(pix_amps[idx])           for pix_amps, idx in zip(pixel_amplitudes, max_indices)]
     # intensity = np.array(intensity)
@@ -521,6 +745,11 @@ def HROI(video, frame2frame_changes, timestamps):
     return hroi_mask, all_roi, change_mask
 
 def save_image(image, name, outdir):
+    if config['IO']['RENDERER'] == 'opencv':
+        render.save_image(image, name, outdir)
+        return
+
+    plt = pyplot()
 
     # Prepare outfigure
     out_fig = outdir / f"{name}.png"
@@ -537,6 +766,11 @@ def save_image(image, name, outdir):
 
 
 def draw_heart_qc_plot(single_frame, abs_changes, all_roi, hroi_mask, out_dir):
+    if config['IO']['RENDERER'] == 'opencv':
+        render.draw_heart_qc_plot(single_frame, abs_changes, all_roi, hroi_mask, out_dir)
+        return
+
+    plt = pyplot()
 
     # Prepare outfigure
     out_fig = out_dir / "embryo_heart_roi.png"
@@ -567,40 +801,58 @@ def draw_heart_qc_plot(single_frame, abs_changes, all_roi, hroi_mask, out_dir):
     plt.close()
 
 def assert_8bit(video):
+    """
+        Converts 32 and 16 bit videos to 8 bit by integer division, in chunks of frames. 8 bit videos are returned as is.
+        Values above the 8 bit range (65280 and up for 16 bit) are set to 255.
+    """
     if video.dtype == np.uint32:
-        video = (video/65535).astype(np.uint16)
+        video16 = np.empty(video.shape, dtype=np.uint16)
+        for chunk_start in range(0, len(video), CHUNK_FRAMES):
+            chunk = slice(chunk_start, chunk_start + CHUNK_FRAMES)
+            video16[chunk] = np.minimum(video[chunk] // 65535, 2**16 - 1)
+        video = video16
+
     if video.dtype == np.uint16:
-        video = (video/255).astype(np.uint8)
+        video8 = np.empty(video.shape, dtype=np.uint8)
+        for chunk_start in range(0, len(video), CHUNK_FRAMES):
+            chunk = slice(chunk_start, chunk_start + CHUNK_FRAMES)
+            video8[chunk] = UINT16_TO_UINT8[video[chunk]]
+        video = video8
 
     return video
 
-def video_with_roi(normed_video, frame2frame_changes, hroi_mask=None):
+def video_with_roi(video8, hroi_mask=None):
     """
         Draws a line around Region of interes in the video.
         Colors in frame2frame changes. Higher change -> stronger color
+        Generates the frames one at a time. video8 holds one more frame than generated, for the change of the last frame.
     """
-    normed_video        = assert_8bit(normed_video)
-    frame2frame_changes = assert_8bit(frame2frame_changes)
+    # Range of the changes, to normalize them like the video
+    min_change, max_change = 255, 0
+    for difference in frame2frame_differences(video8):
+        min_change = min(min_change, np.min(difference))
+        max_change = max(max_change, np.max(difference))
+    change_lut = normalization_lut(min_change, max_change, np.uint8)
 
-    changes_video       = normVideo(frame2frame_changes)
-    
-    roi_video           = np.array([cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB) for frame in normed_video])
-
-    # Increase brightness to contrast changes
-    roi_video           = cv2.add(roi_video, 120)
-    
-    # Color in changes
-    roi_video[:-1,:,:,1] = np.array([cv2.subtract(frame[:,:,1], change_mask)
-                            for frame, change_mask in zip(roi_video[:-1], changes_video)])
-    
-    # Draw outline of Heart ROI
     if hroi_mask is not None:
         contours, _ = cv2.findContours(hroi_mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
 
-        roi_video = np.array([cv2.drawContours(frame, contours, -1, 255, thickness=1)
-                                for frame in roi_video])
+    nr_frames = len(video8) - 1
+    for i, (frame, difference) in enumerate(zip(video8, frame2frame_differences(video8))):
+        roi_frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+
+        # Increase brightness to contrast changes
+        roi_frame = cv2.add(roi_frame, 120)
+
+        # Color in changes, except on the last frame
+        if i < nr_frames - 1:
+            roi_frame[:,:,1] = cv2.subtract(roi_frame[:,:,1], change_lut[difference])
+
+        # Draw outline of Heart ROI
+        if hroi_mask is not None:
+            cv2.drawContours(roi_frame, contours, -1, 255, thickness=1)
 
-    return roi_video
+        yield roi_frame
 
 def run(video, args, video_metadata):
     """
@@ -615,9 +867,15 @@ def run(video, args, video_metadata):
     qc_attributes = {}
 
     ################################################################################ Setup
+    artifact_level = config['IO']['ARTIFACT_LEVEL']
+    if artifact_level not in ARTIFACT_LEVELS:
+        raise ValueError(f"ARTIFACT_LEVEL must be one of {', '.join(ARTIFACT_LEVELS)}, not '{artifact_level}'")
+    full_artifacts = artifact_level == 'full'
+
     # Add well position to output directory path
     out_dir = args['outdir'] / video_metadata['channel'] / f"{video_metadata['loop']}-{video_metadata['well_id']}"
-    out_dir.mkdir(parents=True, exist_ok=True)
+    if artifact_level != 'none':
+        out_dir.mkdir(parents=True, exist_ok=True)
 
     # Ensures np array not lists.
     video = np.asarray(video)
@@ -629,32 +887,32 @@ def run(video, args, video_metadata):
     ################################# Normalize Frames
     LOGGER.info("Normalizing frames")
     
-    normed_video = normVideo(video)
+    normed_video = normVideo(video, in_place=True)
     del video
 
     ################################# Interpolate pixel values (assume timestamps of filenames valid)
     artificial_timestamps = config['ANALYSIS'].getboolean('ARTIFICIAL_TIMESTAMPS')
 
+    # Otherwise frames keep their timestamps. Only the pixel signals used for the Fourier analysis are interpolated
+    # (see HROI and bpm_from_heartregion), not the whole video.
     if artificial_timestamps:
         timestamps = equally_spaced_timestamps(len(timestamps), fps)
-    else:
-        normed_video, timestamps = interpolate_timestamps(normed_video, timestamps)
-        timestamps = timestamps_in_seconds(timestamps)
 
-    LOGGER.info("Writing video")
-    save_video(normed_video, fps, out_dir, "embryo.mp4")
+    # 8 bit video for the output videos and the region detection, converted once (No effect if video loaded in 8bit anyway)
+    video8  = assert_8bit(normed_video)
+
+    if full_artifacts:
+        LOGGER.info("Writing video")
+        save_video(video8, fps, out_dir, "embryo.mp4")
 
     ################################ Detect HROI and write into figure. 
     LOGGER.info("Detecting HROI")
-
-    # Runs the region detection in 8 bit (No effect if video loaded in 8bit anyway)
-    video8  = assert_8bit(normed_video)
     
-    frame2frame_changes = absdiff_between_frames(video8)
-    frame2frame_changes_thresh= threshold_changes(frame2frame_changes)
+    # Changes of all frames. Only sums and masks are kept, not the change videos.
+    change_sums, changed, difference_sum = detect_changes(video8)
 
     # Detect movement and stop analysis early
-    start_frame, stop_frame, max_change = detect_movement(frame2frame_changes_thresh)
+    start_frame, stop_frame, max_change = detect_movement(change_sums)
     qc_attributes["Movement detection max"] = max_change
     qc_attributes["Start frame(movement)"] = str(start_frame)
     qc_attributes["Stop frame(movement)"] = str(stop_frame)
@@ -665,55 +923,62 @@ def run(video, args, video_metadata):
         return None, fps, qc_attributes
 
     # Adjust data for movement
+    # Changes start_frame:stop_frame are between frames start_frame and stop_frame (inclusive).
+    if (start_frame, stop_frame) != (0, len(change_sums)):
+        _, changed, difference_sum = detect_changes(video8[start_frame:stop_frame+1])
+
+    # Frames with their changes, for the quality control video
+    video8_with_changes         = video8[start_frame:stop_frame+1]
+
     normed_video                = normed_video[start_frame:stop_frame]
     video8                      = video8[start_frame:stop_frame]
-    frame2frame_changes         = frame2frame_changes[start_frame:stop_frame]
-    frame2frame_changes_thresh  = frame2frame_changes_thresh[start_frame:stop_frame]
     timestamps                  = timestamps[start_frame:stop_frame]
 
     # Detect region of interest
-    hroi_mask, all_roi, total_changes = HROI(normed_video, frame2frame_changes_thresh, timestamps)
+    hroi_mask, all_roi, total_changes = HROI(normed_video, changed, timestamps, interpolate=not artificial_timestamps)
 
     if hroi_mask is None:
         LOGGER.info("Couldn't detect a suitable heart region")
 
         # image of pixels considered for the heart region..
-        save_image(all_roi*255, "ROI_pixels", out_dir)
+        if full_artifacts:
+            render_artifact(save_image, all_roi*255, "ROI_pixels", out_dir)
         #TODO: include error message if issue here
         # qc_attributes["Error"] = 'No ROI for the heart detected'
         return None, fps, qc_attributes
 
     # Output video and region plot for manual quality control.
-    roi_qc_video = video_with_roi(video8, frame2frame_changes, hroi_mask)
-    save_video(roi_qc_video, fps, out_dir, "embryo_changes.mp4")
-
-    draw_heart_qc_plot(video8[0],
-                        total_changes,
-                        hroi_mask*255, 
-                        all_roi*255, 
-                        out_dir)
+    if full_artifacts:
+        save_video(video_with_roi(video8_with_changes, hroi_mask), fps, out_dir, "embryo_changes.mp4")
+
+        render_artifact(draw_heart_qc_plot,
+                            video8[0],
+                            total_changes,
+                            hroi_mask*255, 
+                            all_roi*255, 
+                            out_dir)
                         
     ################################ Keep only pixels in HROI
     # delete pixels outside of mask (=HROI)
     # flattens frames to 1D arrays (following pixelwise analysis doesn't need to preserve shape of individual images)
-    mask = np.invert(hroi_mask*255)
-    hroi_pixels = np.asarray([np.ma.masked_array(frame, mask).compressed() for frame in normed_video])
+    # hroi_pixels.shape = (nr_frames, nr_hroi_pixels)
+    hroi_pixels = normed_video[:, hroi_mask.astype(bool)]
 
     heart_size = np.size(hroi_pixels, 1)
     qc_attributes["Heart size"] = str(heart_size)
 
     # Sum of absolute brightness changes over all pixels, over all frames.
-    qc_attributes["HROI Change Intensity"] = str(np.sum(np.multiply(hroi_mask, np.sum(frame2frame_changes, axis=0))) / heart_size)
+    qc_attributes["HROI Change Intensity"] = str(np.sum(np.multiply(hroi_mask, difference_sum)) / heart_size)
 
     # For quality control. Fluorescend data may need adjustment for this.
-    empty_frames = [i for i, frame in enumerate(normed_video) if not np.any(cv2.bitwise_and(frame, frame, mask=hroi_mask))]
-    qc_attributes["empty frames"] = str(len(empty_frames))
+    empty_frames = ~np.any(hroi_pixels, axis=1)
+    qc_attributes["empty frames"] = str(np.count_nonzero(empty_frames))
 
     ################################################################################ Fourier Frequency estimation
     LOGGER.info("Fourier frequency evaluation")
     
     # Run Fourier in segemented area
-    bpm, qc_data = bpm_from_heartregion(hroi_pixels, timestamps, out_dir)
+    bpm, qc_data = bpm_from_heartregion(hroi_pixels, timestamps, out_dir, interpolate=not artificial_timestamps, artifact_level=artifact_level)
 
     # Add attributes from frequency analysis to dictionary
     qc_attributes.update(qc_data)
@@ -721,7 +986,4 @@ def run(video, args, video_metadata):
     if not bpm:
         LOGGER.info("No bpm detected")
 
-    # ensures no memory leaks
-    plt.close('all')
-    
     return bpm, fps, qc_attributes
\ No newline at end of file
@@ -63,6 +63,8 @@ def parse_arguments():
     # Cropping Arguments
     parser.add_argument('--crop',           action="store_true",    dest='crop',
                         help='Crops images, does not analyze BPM',              required=False)
+    parser.add_argument('--crop_bpm',       action="store_true",    dest='crop_bpm',
+                        help='Crops images and analyzes BPM on the cropped videos in the same job', required=False)
     
     # Cluster arguments. Index is hidden argument that is set through bash script to assign wells to cluster instances.
     parser.add_argument('--cluster',        action="store",    dest='cluster', type=str, choices=['lsf', 'slurm', False], default=False,
@@ -74,10 +76,14 @@ def parse_arguments():
     # parser.add_argument('-x', '--lsf_index', action="store",         dest='lsf_index',
     #                     help=argparse.SUPPRESS,                                 required=False)
 
+    # Resume an interrupted analysis
+    parser.add_argument('--resume',         action="store_true",    dest='resume',
+                        help='Skip wells already in the results journal of outdir', required=False)
+
     # Debug flag
     parser.add_argument('--debug',          action="store_true",    dest='debug',
                         help='Additional debug output',                          required=False)
-    parser.set_defaults(crop=False, cluster=False, email=False, debug=False)
+    parser.set_defaults(crop=False, crop_bpm=False, cluster=False, email=False, debug=False, resume=False)
     
     args = parser.parse_args()
 
@@ -88,6 +94,15 @@ def parse_arguments():
 
     return args
 
+# Output directory of an experiment, named after the experiment folder and the software version.
+def experiment_outdir(indir, outdir):
+    experiment_folder = Path(indir)
+    if experiment_folder.name == "croppedRAWTiff":
+        experiment_folder = experiment_folder.parent
+
+    software_version = config['DEFAULT']['VERSION']
+    return Path(outdir) / f"{experiment_folder.name}_medaka_bpm_out_{software_version}"
+
 # Processing, done after the logger in the main file has been set up
 def process_arguments(args, is_cluster_node=False):
 
@@ -108,10 +123,8 @@ def process_arguments(args, is_cluster_node=False):
     # Do not do for cluster nodes, already created on dispatch
     if not is_cluster_node:
         
-        software_version = config['DEFAULT']['VERSION']
-
         # Outdir should start with experiment name
-        args.outdir = args.outdir / f"{experiment_folder.name}_medaka_bpm_out_{software_version}"
+        args.outdir = experiment_outdir(experiment_folder, args.outdir)
         args.outdir.mkdir(parents=True, exist_ok=True)
         
         results_dir = args.outdir / 'results'
@@ -0,0 +1,127 @@
+############################################################################################################
+# License: GNU GENERAL PUBLIC LICENSE Version 3
+###
+# Tests of input and output (src/io_operations.py).
+# Usage: python -m pytest tests
+###
+############################################################################################################
+import argparse
+import os
+from pathlib import Path
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import tifffile
+
+# Imports from base dir of repository
+parent_dir = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(parent_dir))
+
+import src.io_operations as io_operations
+
+def well_result(well_id, bpm=None, error=None):
+    result = {'well_id': well_id, 'loop': 'LO001', 'channel': 'CO6', 'bpm': bpm,
+              'version': io_operations.config['DEFAULT']['VERSION']}
+    if error:
+        result['error'] = error
+    return result
+
+# --resume analyses failed wells again, successful wells are taken from the journal
+def test_read_journal_skips_failed_wells(tmp_path):
+    io_operations.append_to_journal(tmp_path, well_result('WE00001', bpm=120), 'settings')
+    io_operations.append_to_journal(tmp_path, well_result('WE00002', error="Error during processing"), 'settings')
+    io_operations.append_to_journal(tmp_path, well_result('WE00003', error="Error during processing"), 'settings')
+    io_operations.append_to_journal(tmp_path, well_result('WE00003', bpm=130), 'settings')
+    io_operations.append_to_journal(tmp_path, well_result('WE00004', bpm=140), 'settings')
+    io_operations.append_to_journal(tmp_path, well_result('WE00004', error="Error during processing"), 'settings')
+    io_operations.append_to_journal(tmp_path, well_result('WE00005', bpm=150), 'other settings')
+
+    journal = io_operations.read_journal(tmp_path, 'settings')
+
+    assert sorted(well for well, _, _ in journal) == ['WE00001', 'WE00003']
+    assert journal[('WE00003', 'LO001', 'CO6')]['bpm'] == 130
+
+# Settings that don't change the results, like the quality control output, don't invalidate resumed results
+def test_settings_hash_ignores_io_settings():
+    args = argparse.Namespace(fps=0.0)
+    settings_id = io_operations.settings_hash(args)
+
+    artifact_level = io_operations.config['IO']['ARTIFACT_LEVEL']
+    try:
+        io_operations.config['IO']['ARTIFACT_LEVEL'] = 'none'
+        assert io_operations.settings_hash(args) == settings_id
+    finally:
+        io_operations.config['IO']['ARTIFACT_LEVEL'] = artifact_level
+
+    assert io_operations.settings_hash(argparse.Namespace(fps=10.0)) != settings_id
+
+# Output settings of the cropping don't invalidate resumed results, analysis settings do
+def test_settings_hash_ignores_cropping_output_settings():
+    args = argparse.Namespace(fps=0.0)
+    settings_id = io_operations.settings_hash(args)
+
+    output_settings = {'SAVE_CROPPED': 'no', 'OUTPUT_FORMAT': 'stack', 'STACK_COMPRESSION': 'zlib'}
+    saved = {key: io_operations.config['CROPPING'][key] for key in output_settings}
+    try:
+        for key, value in output_settings.items():
+            io_operations.config['CROPPING'][key] = value
+        assert io_operations.settings_hash(args) == settings_id
+    finally:
+        for key, value in saved.items():
+            io_operations.config['CROPPING'][key] = value
+
+    max_bpm = io_operations.config['ANALYSIS']['MAX_BPM']
+    try:
+        io_operations.config['ANALYSIS']['MAX_BPM'] = '250'
+        assert io_operations.settings_hash(args) != settings_id
+    finally:
+        io_operations.config['ANALYSIS']['MAX_BPM'] = max_bpm
+
+# The frame index manifest is reused until frames are added to or removed from the directory
+def test_load_frame_index_detects_changed_directory(tmp_path):
+    indir = tmp_path / 'experiment'
+    outdir = tmp_path / 'out'
+    indir.mkdir()
+    frames = sorted((parent_dir / 'data' / 'test_video').glob('*.tif'))[:5]
+    for frame in frames:
+        (indir / frame.name).symlink_to(frame)
+
+    # Manifests are only written for directories not modified just now
+    past = time.time() - 10 * io_operations.MANIFEST_MIN_AGE
+    os.utime(indir, (past, past))
+
+    assert len(io_operations.load_frame_index(indir, outdir)) == 5
+    assert (outdir / io_operations.MANIFEST_NAME).is_file()
+    assert len(io_operations.load_frame_index(indir, outdir)) == 5
+
+    (indir / frames[0].name).unlink()
+    assert len(io_operations.load_frame_index(indir, outdir)) == 4
+
+# Columns missing in a row, or new in it, are None in the other rows. List values (qc attributes) stay whole.
+def test_results_frame_matches_rows():
+    rows = [{'well_id': 'WE00001', 'bpm': 120, 'SNR': 0.5, 'movement': False, 'peaks': [1, 2]},
+            {'well_id': 'WE00002', 'bpm': None, 'error': "Error during processing"},
+            {'well_id': 'WE00003', 'bpm': 130, 'SNR': 0.7, 'movement': True, 'peaks': [3]}]
+
+    results = {}
+    for row in rows:
+        io_operations.append_result(results, row)
+    frame = io_operations.results_frame(results)
+
+    columns = dict.fromkeys(column for row in rows for column in row)
+    expected = pd.DataFrame({column: [row.get(column) for row in rows] for column in columns})
+    pd.testing.assert_frame_equal(frame, expected)
+    assert frame['peaks'].tolist() == [[1, 2], None, [3]]
+
+# Tiled TIFFs can't be read strip-wise and fall back to decoding the whole frame
+def test_read_frame_region_tiled_tiff(tmp_path):
+    frame = np.arange(128 * 192, dtype=np.uint16).reshape(128, 192)
+    path = tmp_path / 'tiled.tif'
+    tifffile.imwrite(path, frame, tile=(64, 64))
+    region = ((10, 100), (20, 150))
+
+    region_frame = io_operations.read_frame_region(str(path), -1, region)
+
+    np.testing.assert_array_equal(region_frame, frame[10:100, 20:150])
@@ -0,0 +1,40 @@
+############################################################################################################
+# License: GNU GENERAL PUBLIC LICENSE Version 3
+###
+# Tests of the OpenCV renderer (src/render.py).
+# Usage: python -m pytest tests
+###
+############################################################################################################
+from pathlib import Path
+import sys
+
+import cv2
+import numpy as np
+
+# Imports from base dir of repository
+parent_dir = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(parent_dir))
+
+import src.render as render
+
+# Virtual cropping builds the panel from colour (BGR) first frames, the full crop from 16 bit greyscale frames
+def test_save_panel_colour_and_greyscale_crops(tmp_path):
+    colour_crop = np.zeros((50, 50, 3), dtype=np.uint8)
+    colour_crop[10:40, 10:40] = (0, 128, 255)
+    greyscale_crop = np.arange(60 * 40, dtype=np.uint16).reshape(60, 40)
+
+    for name, crop in (('colour', colour_crop), ('greyscale', greyscale_crop)):
+        outfile_path = tmp_path / f"{name}_panel.png"
+        render.save_panel([crop], ['WE00001'], 'General view of every cropped well in CO6_LO001', outfile_path)
+
+        panel = cv2.imread(str(outfile_path))
+        assert panel is not None
+        assert panel.shape[1] > 12 * render.PANEL_TILE_SIZE
+
+def test_colorize_keeps_colour_images():
+    image = np.zeros((5, 5, 3), dtype=np.uint8)
+    image[..., 2] = 255
+
+    assert render.colorize(image).shape == (5, 5, 3)
+    assert render.colorize(image, cv2.COLORMAP_VIRIDIS).shape == (5, 5, 3)
+    assert render.colorize(image[..., 0]).shape == (5, 5, 3)
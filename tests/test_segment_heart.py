@@ -0,0 +1,54 @@
+############################################################################################################
+# License: GNU GENERAL PUBLIC LICENSE Version 3
+###
+# Tests of the heart rate analysis (src/segment_heart.py).
+# Usage: python -m pytest tests
+###
+############################################################################################################
+from pathlib import Path
+import sys
+
+import numpy as np
+from skimage.filters import threshold_triangle
+
+# Imports from base dir of repository
+parent_dir = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(parent_dir))
+
+import src.segment_heart as segment_heart
+
+# 8 bit frames with the intensity distributions seen in frame to frame differences and in raw frames
+def random_frames(rng, nr_frames, shape):
+    frames = []
+    for i in range(nr_frames):
+        kind = i % 5
+        if kind == 0:
+            # Mostly unchanged pixels, few large changes
+            frame = rng.exponential(rng.uniform(0.5, 20), size=shape)
+        elif kind == 1:
+            frame = rng.normal(rng.uniform(20, 230), rng.uniform(1, 60), size=shape)
+        elif kind == 2:
+            frame = rng.uniform(0, 256, size=shape)
+        elif kind == 3:
+            # Few intensity levels
+            frame = rng.choice(rng.integers(0, 256, size=rng.integers(2, 6)), size=shape)
+        else:
+            # Peak at the upper end, long tail to the left
+            frame = 255 - rng.exponential(rng.uniform(1, 40), size=shape)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+
+    return np.array(frames)
+
+def test_threshold_triangle_frames_matches_skimage():
+    rng = np.random.default_rng(0)
+    for shape in ((7, 5), (64, 64), (120, 90)):
+        frames = random_frames(rng, 400, shape)
+        thresholds = segment_heart.threshold_triangle_frames(frames)
+
+        expected = [threshold_triangle(frame) for frame in frames]
+        np.testing.assert_array_equal(thresholds, expected)
+
+def test_threshold_triangle_frames_constant_frames():
+    frames = np.stack([np.full((10, 10), value, dtype=np.uint8) for value in (0, 17, 255)])
+
+    np.testing.assert_array_equal(segment_heart.threshold_triangle_frames(frames), [0, 17, 255])